@@ -0,0 +1,74 @@
+# Compares Submapper's free space engines on synthetic rooms.
+# The flood and scanline fills are checked to agree cell for cell, with every wall where the
+# observer saw it from the center of the submap; ray casting carves beams only,
+# and is checked to stay within a cell of every beam, out to the range of a long corridor.
+# Run with: python -m benchmark.fill
+from benchmark import synthetic
+from lidar import g2
+from mapper import mapper
+from mapper import raycast
+import numpy as np
+import time
+
+RESOLUTIONS = (36, 18, 8, 4)
+SCANS = 10
+
+
+def time_engine(fill: str, resolution: int, scans) -> tuple[float, list]:
+    submapper = mapper.Submapper(resolution, fill)
+    submaps = []
+    start = time.perf_counter()
+    for scan in scans:
+        submaps.append(submapper.lidar_to_submap(scan))
+    return (time.perf_counter() - start) / len(scans), submaps
+
+
+def check_walls(resolution: int, scan: g2.LaserScan, submap: mapper.Map) -> None:
+    # Observers are off-center in their rooms, so walls must not be clamped to the submap's edge.
+    xs, ys = scan.gate().to_cartesian()
+    x_center, y_center = submap.get_center_point()
+    xs = np.trunc(xs).astype(np.int64) // resolution + x_center
+    ys = np.trunc(ys).astype(np.int64) // resolution + y_center
+    assert (submap.content[ys, xs] == mapper.OCCUPIED).all(), "Walls moved off their returns."
+
+
+def check_ray_table(resolution: int, scan: g2.LaserScan) -> None:
+    # Every beam cast from the table against its true line: freed cells within a cell of it,
+    # measured across, and ending where the beam does.
+    table = raycast.ray_table(resolution)
+    scan = scan.gate()
+    for radian, distance in zip(scan.radians, scan.distances):
+        free, ends, hit = table.cast(np.array([radian]), np.array([distance]))
+        cos, sin = np.cos(radian), np.sin(radian)
+        across = np.abs(free[:, 0] * sin - free[:, 1] * cos)
+        assert (across <= 1).all(), "Ray table drifted off the beam."
+        along = ends[0, 0] * cos + ends[0, 1] * sin
+        # Ends are rounded down to a whole step, up to a diagonal cell short.
+        assert not hit[0] or abs(along - distance / resolution) < 2, "Beam ends elsewhere."
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    scans = [
+        synthetic.cast_scan(
+            synthetic.rectangular_room(rng.uniform(2000, 8000), rng.uniform(2000, 8000)),
+            rng,
+            observer=(rng.uniform(-500, 500), rng.uniform(-500, 500)),
+        )
+        for _ in range(SCANS)
+    ]
+    corridor = synthetic.cast_scan(synthetic.corridor(30000), rng)
+
+    print(f"{'resolution':>10} {'flood (ms)':>11} {'scanline (ms)':>14} {'raycast (ms)':>13}")
+    for resolution in RESOLUTIONS:
+        flood, expected = time_engine(mapper.FLOOD_FILL, resolution, scans)
+        scanline, result = time_engine(mapper.SCANLINE_FILL, resolution, scans)
+        for scan, a, b in zip(scans, expected, result):
+            assert a.dimension == b.dimension and (a.content == b.content).all(), "Fill engines disagree."
+            check_walls(resolution, scan, b)
+        check_ray_table(resolution, scans[0])
+        check_ray_table(resolution, corridor)
+        # The first scan also traces the ray table, so warm it up before timing.
+        time_engine(mapper.RAYCAST, resolution, scans[:1])
+        carved, _ = time_engine(mapper.RAYCAST, resolution, scans)
+        print(f"{resolution:>10} {flood * 1e3:11.2f} {scanline * 1e3:14.2f} {carved * 1e3:13.2f}")
@@ -0,0 +1,209 @@
+# Compares packets per second of the buffered G2 decoders against byte-at-a-time reads.
+# The stream is read through a file descriptor, so that every read() is a system call like it is
+# on the serial port, and the read() calls per revolution are reported along.
+# A corrupted copy of the stream checks that the framer drops damaged packets and junk, and
+# resynchronizes on the next good header.
+# Run with: python -m benchmark.g2_decoder
+from benchmark import synthetic
+from lidar import framing
+from lidar import g2
+from typing import List
+import math
+import numpy as np
+import os
+import random
+import tempfile
+import time
+
+REVOLUTIONS = 200
+PACKETS_PER_REVOLUTION = 12
+BIT_FLIPS = 40
+JUNK_RUNS = 20
+
+
+class BytewiseG2(g2.G2):
+    # The previous decoder, which calls read() once per header byte, field and sample.
+    def _parse_response(self):
+        self._serial.read(g2.RESPONSE_SIZE)
+
+    def _parse_one_cycle(self) -> List[g2.LaserScanPoint]:
+        header_count = 0
+        scanned_points: List[g2.LaserScanPoint] = []
+        is_first_header = True
+
+        while True:
+            received = self._serial.read()
+            if received == g2.SCAN_HEADER[header_count]:
+                header_count = header_count + 1
+            if header_count < 2:
+                continue
+
+            status = int.from_bytes(self._serial.read(), "little")
+            quantity = int.from_bytes(self._serial.read(), "little")
+            fsa = int.from_bytes(self._serial.read(2), "little")
+            lsa = int.from_bytes(self._serial.read(2), "little")
+            check_code = int.from_bytes(self._serial.read(2), "little")
+            header = g2.ScanHeader(
+                (status >> 1) / 10,
+                status & 0b1,
+                quantity,
+                (fsa >> 1) / 64,
+                (lsa >> 1) / 64,
+                check_code,
+            )
+
+            for i in range(0, header.quantity):
+                sample_data = int.from_bytes(self._serial.read(3), "little")
+                second_byte = (sample_data >> 8) & 0b11111111
+                third_byte = (sample_data >> 16) & 0b11111111
+                angle_diff = (
+                    (header.end_angle + 360) - header.start_angle
+                    if header.end_angle - header.start_angle < 0
+                    else header.end_angle - header.start_angle
+                )
+                distance = (third_byte << 6) + (second_byte >> 2)
+                angle = angle_diff / (header.quantity + 1) * (i + 1) + header.start_angle
+                correcting_angle = (
+                    0
+                    if distance == 0
+                    else math.atan2(21.8 * (155.3 - distance), (155.3 * distance))
+                )
+                final_radian = math.radians(math.fmod(angle + correcting_angle, 360))
+                scanned_points.append(g2.LaserScanPoint(final_radian, distance))
+
+            if not is_first_header and header.packet_type == g2.START_DATA:
+                break
+
+            is_first_header = False
+            header_count = 0
+
+        return scanned_points
+
+
+class FileTransport:
+    # Stand-in for serial.Serial over a file, with one os.read() per read(), counted in `reads`.
+    reads: int
+
+    def __init__(self, path: str) -> None:
+        self._fd = os.open(path, os.O_RDONLY)
+        self._size = os.fstat(self._fd).st_size
+        self.reads = 0
+
+    @property
+    def in_waiting(self) -> int:
+        return self._size - os.lseek(self._fd, 0, os.SEEK_CUR)
+
+    def read(self, size: int = 1) -> bytes:
+        self.reads += 1
+        return os.read(self._fd, size)
+
+    def write(self, data) -> int:
+        return len(data)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def decode_all(lidar: g2.G2, cycles: int, as_arrays: bool):
+    parse = lidar._parse_one_cycle_arrays if as_arrays else lidar._parse_one_cycle
+    lidar._parse_response()
+    return [parse() for _ in range(cycles)]
+
+
+def split_packets(stream: bytes) -> List[bytes]:
+    packets = []
+    offset = 0
+    while offset < len(stream):
+        quantity = stream[offset + 3]
+        size = framing.PACKET_HEADER.size + quantity * framing.PACKET_SAMPLE.size
+        packets.append(stream[offset : offset + size])
+        offset += size
+    return packets
+
+
+def check_corrupted(stream: bytes, rng: np.random.Generator) -> framing.PacketFramer:
+    # Flips a bit in BIT_FLIPS packets and slips junk, header look-alikes included, between
+    # others. Exactly the flipped packets must be lost, and every junk byte dropped.
+    packets = split_packets(stream[len(synthetic.SCAN_RESPONSE) :])
+    flipped = set(rng.choice(len(packets), BIT_FLIPS, replace=False).tolist())
+    junk_after = set(rng.choice(len(packets), JUNK_RUNS, replace=False).tolist())
+
+    corrupted = bytearray(synthetic.SCAN_RESPONSE)
+    junk_bytes = 0
+    for i, packet in enumerate(packets):
+        packet = bytearray(packet)
+        if i in flipped:
+            bit = int(rng.integers(len(packet) * 8))
+            packet[bit // 8] ^= 1 << (bit % 8)
+        corrupted += packet
+        if i in junk_after:
+            junk = rng.integers(0, 256, int(rng.integers(1, 32)), dtype=np.uint8).tobytes()
+            if rng.random() < 0.5:
+                junk = framing.SCAN_HEADER_BYTES + junk
+            corrupted += junk
+            junk_bytes += len(junk)
+
+    lidar = g2.G2(None, synthetic.BytesTransport(bytes(corrupted)))
+    lidar._parse_response()
+    cycles = 0
+    try:
+        while True:
+            lidar._parse_one_cycle_arrays()
+            cycles += 1
+    except TimeoutError:
+        # The stream ran out.
+        pass
+
+    framer = lidar.framer
+    assert framer.packets == len(packets) - len(flipped), "Lost or let through a packet."
+    assert framer.dropped_packets > 0, "No damaged packet was rejected."
+    assert framer.dropped_bytes >= junk_bytes, "Junk made it into packets."
+    assert cycles >= REVOLUTIONS - BIT_FLIPS, "Too few revolutions survived."
+    return framer
+
+
+def run(lidar_class, path: str, cycles: int, as_arrays: bool = False):
+    transport = FileTransport(path)
+    lidar = lidar_class(None, transport)
+
+    start = time.perf_counter()
+    result = decode_all(lidar, cycles, as_arrays)
+    elapsed = time.perf_counter() - start
+    transport.close()
+
+    # Every cycle ends on the next START_DATA packet, so count what was consumed.
+    packets = cycles * (PACKETS_PER_REVOLUTION + 1)
+    return result, packets / elapsed, transport.reads / cycles
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    stream = synthetic.SCAN_RESPONSE + synthetic.g2_revolutions(
+        REVOLUTIONS + 1, packets_per_revolution=PACKETS_PER_REVOLUTION
+    )
+    path = os.path.join(tempfile.gettempdir(), "g2_decoder.g2")
+    with open(path, "wb") as f:
+        f.write(stream)
+
+    bytewise, bytewise_rate, bytewise_reads = run(BytewiseG2, path, REVOLUTIONS)
+    buffered, buffered_rate, buffered_reads = run(g2.G2, path, REVOLUTIONS)
+    vectorized, vectorized_rate, vectorized_reads = run(g2.G2, path, REVOLUTIONS, as_arrays=True)
+    os.remove(path)
+    assert bytewise == buffered, "Decoders disagree on the decoded cycles."
+    for points, scan in zip(buffered, vectorized):
+        assert np.array_equal([p.distance for p in points], scan.distances)
+        assert np.allclose([p.radian for p in points], scan.radians)
+
+    print(f"{'decoder':<10} {'packets/s':>12} {'speedup':>8} {'reads/rev':>10}")
+    for name, rate, reads in (
+        ("bytewise", bytewise_rate, bytewise_reads),
+        ("buffered", buffered_rate, buffered_reads),
+        ("vectorized", vectorized_rate, vectorized_reads),
+    ):
+        print(f"{name:<10} {rate:12.1f} {rate / bytewise_rate:7.2f}x {reads:10.1f}")
+
+    framer = check_corrupted(stream, np.random.default_rng(0))
+    print(
+        f"corrupted  : {framer.packets} packets kept, {framer.dropped_packets} dropped, "
+        f"{framer.dropped_bytes} bytes skipped"
+    )
@@ -0,0 +1,72 @@
+# Checks that ScanMatcher finds turned observers back in a square room, and times it there and
+# along a corridor.
+# Run with: python -m benchmark.matcher
+from benchmark import synthetic
+from dataclasses import replace
+from lidar import g2
+from mapper import mapper
+from mapper import matcher
+import math
+import numpy as np
+import time
+
+# At finer resolutions the simulated range noise spreads walls over more than a cell,
+# and matches score right around matcher.MIN_SCORE.
+RESOLUTIONS = (36, 18)
+TURNS = (-15, -5, 0, 5, 15)  # in degrees, within the angular window.
+HEADINGS = (0, 45, 90, 135, 180, 270)  # initial guesses, in degrees.
+SCANS = 10
+
+
+def turned(scan: g2.LaserScan, degrees: int) -> g2.LaserScan:
+    # The scan as seen by an observer turned by `degrees`, rounded to whole samples.
+    shift = round(math.radians(degrees) / (2 * math.pi) * len(scan))
+    return replace(scan, distances=np.roll(scan.distances, -shift))
+
+
+def check_room(resolution: int, rng: np.random.Generator) -> float:
+    # Returns the mean time of a match, in seconds.
+    room = synthetic.rectangular_room(6000, 6000)
+    submapper = mapper.Submapper(resolution)
+    scan_matcher = matcher.ScanMatcher(resolution)
+    global_mapper = mapper.GlobalMapper(track_distance=False)
+    global_mapper.update(submapper.lidar_to_submap(synthetic.cast_scan(room, rng)))
+    grid = global_mapper.occupancy_grid
+
+    elapsed = []
+    for degrees in TURNS:
+        scan = turned(synthetic.cast_scan(room, rng), degrees)
+        result = scan_matcher.match(grid, scan, mapper.Pose(0, 0, 0.0))
+        assert result is not None, f"No match for a {degrees} degree turn."
+        assert abs(math.degrees(result.pose.theta) - degrees) < 1, "Wrong heading."
+        assert abs(result.pose.x) <= 1 and abs(result.pose.y) <= 1, "Wrong position."
+        elapsed.append(result.elapsed_ns)
+
+    # Any heading must stay within the grid, match or not.
+    for degrees in HEADINGS:
+        initial = mapper.Pose(0, 0, math.radians(degrees))
+        scan_matcher.match(grid, synthetic.cast_scan(room, rng), initial)
+    return np.mean(elapsed) / 1e9
+
+
+def time_corridor(resolution: int, rng: np.random.Generator) -> float:
+    scene = synthetic.corridor(30000)
+    submapper = mapper.Submapper(resolution)
+    scan_matcher = matcher.ScanMatcher(resolution)
+    global_mapper = mapper.GlobalMapper(track_distance=False)
+    global_mapper.update(submapper.lidar_to_submap(synthetic.cast_scan(scene, rng)))
+
+    scans = [synthetic.cast_scan(scene, rng, observer=(i * 50.0, 0)) for i in range(SCANS)]
+    start = time.perf_counter()
+    for scan in scans:
+        scan_matcher.match(global_mapper.occupancy_grid, scan, mapper.Pose(0, 0, 0.0))
+    return (time.perf_counter() - start) / len(scans)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    print(f"{'resolution':>10} {'room (ms)':>10} {'corridor (ms)':>14}")
+    for resolution in RESOLUTIONS:
+        room = check_room(resolution, rng)
+        corridor = time_corridor(resolution, rng)
+        print(f"{resolution:>10} {room * 1e3:10.1f} {corridor * 1e3:14.1f}")
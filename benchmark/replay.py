@@ -0,0 +1,58 @@
+# Replays a G2 capture through the decoder and the mapper, and reports their throughput.
+# Run with: python -m benchmark.replay [CAPTURE] [--realtime]
+# Without a capture, a synthetic one is generated first.
+from benchmark import synthetic
+from lidar import g2
+from lidar import replay
+from mapper import mapper
+import os
+import random
+import sys
+import tempfile
+import time
+
+RESOLUTION = 18
+SYNTHETIC_REVOLUTIONS = 50
+
+
+def decode_capture(transport: replay.ReplayTransport):
+    lidar = g2.G2(None, transport)
+    lidar._parse_response()
+
+    cycles = []
+    try:
+        while True:
+            cycles.append(lidar._parse_one_cycle())
+    except TimeoutError:
+        # The recording ran out.
+        pass
+    return cycles
+
+
+if __name__ == "__main__":
+    arguments = [a for a in sys.argv[1:] if not a.startswith("--")]
+    realtime = "--realtime" in sys.argv
+
+    if arguments:
+        path = arguments[0]
+    else:
+        random.seed(0)
+        path = os.path.join(tempfile.gettempdir(), "synthetic.g2raw")
+        stream = synthetic.g2_revolutions(SYNTHETIC_REVOLUTIONS)
+        synthetic.write_capture(path, synthetic.SCAN_RESPONSE + stream)
+
+    transport = replay.ReplayTransport(path, realtime)
+    start = time.perf_counter()
+    cycles = decode_capture(transport)
+    decode_elapsed = time.perf_counter() - start
+
+    submapper = mapper.Submapper(RESOLUTION)
+    global_mapper = mapper.GlobalMapper()
+    start = time.perf_counter()
+    for cycle in cycles:
+        global_mapper.update(submapper.lidar_to_submap(cycle))
+    mapping_elapsed = time.perf_counter() - start
+
+    print(f"capture  : {path} ({len(transport)} bytes, {len(cycles)} revolutions)")
+    print(f"decoding : {len(cycles) / decode_elapsed:10.1f} scans/s")
+    print(f"mapping  : {len(cycles) / mapping_elapsed:10.1f} scans/s")
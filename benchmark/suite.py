@@ -0,0 +1,337 @@
+# Benchmark suite for the LiDAR -> submap -> global map pipeline, on deterministic synthetic scans.
+#
+# Run with: python -m benchmark.suite [--save FILE] [--baseline FILE] [--tolerance 0.1] [--quick]
+# --save stores the results as JSON, --baseline compares against such a file and exits with 1
+# if any stage got slower than the tolerance allows.
+from benchmark import synthetic
+from lidar import g2
+from mapper import bresenham
+from mapper import mapper
+from mapper import matcher
+from mapper import pipeline
+from mapper import tilestore
+from pose import heading
+from typing import Callable, Dict, List
+
+import argparse
+import json
+import math
+import os
+import numpy as np
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SEED = 0
+RESOLUTIONS = (36, 18, 8)
+MAP_SIZES = (500, 2000)
+ENGINES = (mapper.SCANLINE_FILL, mapper.RAYCAST)
+
+
+def scenes(rng: np.random.Generator) -> Dict[str, synthetic.Scene]:
+    return {
+        "room": synthetic.rectangular_room(6000, 4500),
+        "corridor": synthetic.corridor(30000),
+        "cluttered": synthetic.cluttered_room(8000, 6000, 40, rng),
+    }
+
+
+def trajectory(scene: synthetic.Scene, count: int, rng: np.random.Generator) -> List[g2.LaserScan]:
+    # The observer drifts along x, as if driving through the scene.
+    return [
+        synthetic.cast_scan(
+            scene, rng, observer=(i * 50.0, rng.normal(0, 20)), timestamp=i * 100_000_000
+        )
+        for i in range(count)
+    ]
+
+
+def measure(
+    run: Callable[..., int], scans: int, repeat: int, setup: Callable[[], tuple] = tuple
+) -> Dict[str, float]:
+    # `run` processes `scans` scans and returns how many cells it produced or touched. Whatever
+    # `setup` returns is passed to `run` and stays out of the timing. Memory is traced in a
+    # separate pass since tracemalloc slows the allocations down considerably.
+    best, cells = math.inf, 0
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        cells = run(*state)
+        best = min(best, time.perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    run(*state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "scans_per_s": scans / best,
+        "cells_per_s": cells / best,
+        "peak_bytes": peak,
+    }
+
+
+def bench_decode(repeat: int) -> Dict[str, Dict[str, float]]:
+    random.seed(SEED)
+    revolutions = 50
+    stream = synthetic.SCAN_RESPONSE + synthetic.g2_revolutions(revolutions + 1)
+
+    def run() -> int:
+        lidar = g2.G2(None, synthetic.BytesTransport(stream))
+        lidar._parse_response()
+        return sum(len(lidar._parse_one_cycle_arrays()) for _ in range(revolutions))
+
+    return {"decode": measure(run, revolutions, repeat)}
+
+
+def bench_deskew(
+    all_scans: Dict[str, List[g2.LaserScan]], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    # Revolutions of 100ms taken while turning at 90 degree per second, with 1kHz of IMU yaw.
+    tracker = heading.HeadingTracker()
+    period = 100_000_000
+    scans = [scan for scene_scans in all_scans.values() for scan in scene_scans]
+    ts = np.arange(0, (len(scans) + 1) * period, 1_000_000)
+    tracker.yaw.extend(ts, ts * (math.pi / 2 / 1e9))
+    for i, scan in enumerate(scans):
+        end = (i + 1) * period
+        scans[i] = g2.LaserScan(
+            scan.radians,
+            scan.distances,
+            end,
+            sample_times=end - period + np.arange(len(scan)) * period // len(scan),
+        )
+
+    def run() -> int:
+        for scan in scans:
+            tracker.deskew(scan)
+        return 0
+
+    return {"deskew": measure(run, len(scans), repeat)}
+
+
+def bench_bresenham(repeat: int, rng: np.random.Generator) -> Dict[str, Dict[str, float]]:
+    segments = rng.integers(-200, 200, size=(4, 720 * 20))
+
+    def run() -> int:
+        xs, _, _ = bresenham.bresenham_batch(*segments)
+        return len(xs)
+
+    # 720 segments make up one scan outline.
+    return {"bresenham": measure(run, 20, repeat)}
+
+
+def bench_submaps(
+    all_scans: Dict[str, List[g2.LaserScan]], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for engine in ENGINES:
+        for resolution in RESOLUTIONS:
+            submapper = mapper.Submapper(resolution, engine)
+            for name, scans in all_scans.items():
+
+                def run() -> int:
+                    return sum(submapper.lidar_to_submap(s).content.size for s in scans)
+
+                results[f"submap/{engine}/{name}/r{resolution}"] = measure(run, len(scans), repeat)
+    return results
+
+
+def bench_fusion(
+    all_scans: Dict[str, List[g2.LaserScan]], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    results = {}
+    resolution = 18
+    submapper = mapper.Submapper(resolution)
+    for name, scans in all_scans.items():
+        submaps = [submapper.lidar_to_submap(s) for s in scans]
+        for size in MAP_SIZES:
+
+            def setup() -> tuple:
+                # Start from an already explored map of size x size cells.
+                return (mapper.GlobalMapper((size, size)),)
+
+            def run(global_mapper: mapper.GlobalMapper) -> int:
+                for i, submap in enumerate(submaps):
+                    global_mapper.update_observer_pos(mapper.Point(i * 50 // resolution, 0))
+                    global_mapper.update(submap)
+                return sum(s.content.size for s in submaps)
+
+            results[f"fusion/{name}/map{size}"] = measure(run, len(submaps), repeat, setup)
+    return results
+
+
+def bench_out_of_core(
+    all_scans: Dict[str, List[g2.LaserScan]], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    # Fusion into a disk-backed grid and distance field, whose working sets are a fraction of
+    # the corridor. Checked to keep no more tiles in memory than that, whatever the length.
+    results = {}
+    resolution = 18
+    submapper = mapper.Submapper(resolution)
+    scans = all_scans["corridor"]
+    submaps = [submapper.lidar_to_submap(s) for s in scans]
+    with tempfile.TemporaryDirectory() as directory:
+        for working_set in (16, 256):
+
+            def setup() -> tuple:
+                stores = [
+                    tilestore.DiskTileStore(
+                        os.path.join(directory, f"{len(os.listdir(directory))}.{name}"),
+                        dtype=dtype,
+                        working_set=working_set,
+                    )
+                    for name, dtype in (("tiles", np.uint8), ("distances", np.float32))
+                ]
+                global_mapper = mapper.GlobalMapper(
+                    grid=mapper.TiledMap(tiles=stores[0]), distance_tiles=stores[1]
+                )
+                return (stores, global_mapper)
+
+            def run(stores: List[tilestore.DiskTileStore], global_mapper: mapper.GlobalMapper) -> int:
+                # Evicted tiles wait for write-back in a bounded queue, on top of the working set.
+                live = working_set + tilestore.WRITE_BACK_CAPACITY + 1
+                for i, submap in enumerate(submaps):
+                    global_mapper.update_observer_pos(mapper.Point(i * 50 // resolution, 0))
+                    global_mapper.update(submap)
+                    for store in stores:
+                        summary = store.summary()
+                        assert summary["cached"] <= working_set, "Working set overflowed."
+                        assert summary["cached"] + summary["pending"] <= live, "Tiles piled up."
+                for store in stores:
+                    store.close()
+                return sum(s.content.size for s in submaps)
+
+            results[f"fusion/disk/tiles{working_set}"] = measure(run, len(submaps), repeat, setup)
+
+        # Resuming from the stored grid seeds distances lazily, and must find the same ones.
+        stores, global_mapper = setup()
+        run(stores, global_mapper)
+        grid = tilestore.DiskTileStore(stores[0].path, working_set=16)
+        resumed = mapper.GlobalMapper(grid=mapper.TiledMap(tiles=grid))
+        expected = tilestore.DiskTileStore(stores[1].path, dtype=np.float32, working_set=16)
+        field = mapper.TiledMap(fill=mapper.MAX_DISTANCE, dtype=np.float32, tiles=expected)
+        x0, y0, x1, y1 = resumed.occupancy_grid.bounds()
+        xs, ys = np.meshgrid(np.arange(x0, x1, 7), np.arange(y0, y1, 7))
+        assert np.array_equal(
+            resumed.distance_field.distances(xs, ys), field.get_many(xs, ys)
+        ), "Lazily seeded distances disagree."
+        grid.close()
+        expected.close()
+    return results
+
+
+def bench_matcher(
+    all_scans: Dict[str, List[g2.LaserScan]], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    results = {}
+    resolution = 18
+    submapper = mapper.Submapper(resolution)
+    scan_matcher = matcher.ScanMatcher(resolution)
+    for name, scans in all_scans.items():
+        global_mapper = mapper.GlobalMapper()
+        global_mapper.update(submapper.lidar_to_submap(scans[0]))
+
+        def run() -> int:
+            initial = mapper.Pose(0, 0, 0.0)
+            for scan in scans[1:]:
+                scan_matcher.match(global_mapper._occupancy_grid, scan, initial)
+            return 0
+
+        results[f"matcher/{name}"] = measure(run, len(scans) - 1, repeat)
+    return results
+
+
+def bench_pipeline(
+    all_scans: Dict[str, List[g2.LaserScan]], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    # Sustained throughput of the staged runtime, with submaps built inline and in a pool.
+    results = {}
+    resolution = 18
+    scans = [scan for scene_scans in all_scans.values() for scan in scene_scans]
+    for workers in sorted({0, max((os.cpu_count() or 1) - 1, 1)}):
+
+        def setup() -> tuple:
+            return (
+                pipeline.MappingPipeline(
+                    scans,
+                    mapper.GlobalMapper((500, 500)),
+                    resolution,
+                    workers=workers,
+                    scan_policy=pipeline.BLOCK,
+                ),
+            )
+
+        def run(runtime: pipeline.MappingPipeline) -> int:
+            runtime.run()
+            return 0
+
+        results[f"pipeline/workers{workers}"] = measure(run, len(scans), repeat, setup)
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float
+) -> List[str]:
+    # Returns the stages whose throughput dropped by more than `tolerance`.
+    regressions = []
+    print(f"\n{'stage':<40} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]["scans_per_s"], current["scans_per_s"]
+        ratio = now / before
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<40} {before:12.1f} {now:12.1f} {ratio:7.2f}{flag}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--quick", action="store_true", help="fewer scans and repetitions")
+    args = parser.parse_args()
+
+    repeat = 1 if args.quick else 3
+    count = 5 if args.quick else 20
+
+    rng = np.random.default_rng(SEED)
+    all_scans = {name: trajectory(scene, count, rng) for name, scene in scenes(rng).items()}
+
+    results = {}
+    results.update(bench_decode(repeat))
+    results.update(bench_bresenham(repeat, rng))
+    results.update(bench_deskew(all_scans, repeat))
+    results.update(bench_submaps(all_scans, repeat))
+    results.update(bench_fusion(all_scans, repeat))
+    results.update(bench_out_of_core(all_scans, repeat))
+    results.update(bench_matcher(all_scans, repeat))
+    results.update(bench_pipeline(all_scans, repeat))
+
+    print(f"{'stage':<40} {'scans/s':>12} {'cells/s':>14} {'peak MiB':>9}")
+    for name, r in results.items():
+        print(
+            f"{name:<40} {r['scans_per_s']:12.1f} {r['cells_per_s']:14.0f} "
+            f"{r['peak_bytes'] / 2**20:9.1f}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
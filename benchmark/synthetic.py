@@ -0,0 +1,179 @@
+from lidar import framing
+from lidar import g2
+from lidar import replay
+from dataclasses import dataclass, field
+from typing import List, Optional
+import math
+import numpy as np
+import random
+
+
+def encode_packet(
+    packet_type: int,
+    start_angle: float,
+    end_angle: float,
+    distances: List[int],
+    frequency: float = 10.0,
+) -> bytes:
+    status = (int(frequency * 10) << 1) | packet_type
+    fsa = (int(start_angle * 64) << 1) | 1
+    lsa = (int(end_angle * 64) << 1) | 1
+    samples = b"".join(
+        framing.PACKET_SAMPLE.pack(random.randrange(256), (d << 2) & 0xFFFF) for d in distances
+    )
+    check = framing.packet_checksum(status, len(distances), fsa, lsa, samples)
+    header = framing.PACKET_HEADER.pack(
+        framing.SCAN_HEADER_BYTES, status, len(distances), fsa, lsa, check
+    )
+    return header + samples
+
+
+# Response G2 sends right after START_SCAN: start sign, length/mode and typecode.
+SCAN_RESPONSE = bytes([0xA5, 0x5A, 0x05, 0x00, 0x00, 0x40, 0x81])
+
+
+class BytesTransport:
+    # Minimal in-memory stand-in for serial.Serial, replaying a fixed byte stream.
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+        self._position = 0
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._data) - self._position
+
+    def read(self, size: int = 1) -> bytes:
+        chunk = self._data[self._position : self._position + size]
+        self._position += len(chunk)
+        return chunk
+
+    def write(self, data) -> int:
+        return len(data)
+
+    def rewind(self) -> None:
+        self._position = 0
+
+
+# Writes `stream` as a capture file, timestamped as if it came in at the G2 baud rate.
+def write_capture(path: str, stream: bytes, chunk_size: int = 512, baud: int = 230400) -> None:
+    # 8N1 framing, so every byte takes 10 bits on the wire.
+    ns_per_byte = 10 * 1e9 / baud
+    with open(path, "wb") as f:
+        f.write(replay.MAGIC)
+        for offset in range(0, len(stream), chunk_size):
+            chunk = stream[offset : offset + chunk_size]
+            elapsed = int((offset + len(chunk)) * ns_per_byte)
+            f.write(replay.RECORD.pack(elapsed, replay.RECEIVED, len(chunk)))
+            f.write(chunk)
+
+
+@dataclass
+class Scene:
+    # Walls as (x0, y0, x1, y1) segments and round obstacles as (x, y, radius), all in mm.
+    walls: List[tuple[float, float, float, float]]
+    obstacles: List[tuple[float, float, float]] = field(default_factory=list)
+
+
+def rectangular_room(width: float, height: float) -> Scene:
+    w, h = width / 2, height / 2
+    return Scene([(-w, -h, w, -h), (w, -h, w, h), (w, h, -w, h), (-w, h, -w, -h)])
+
+
+def corridor(length: float, width: float = 1800, doors: int = 6) -> Scene:
+    # A long corridor along x, with door-sized gaps on both sides.
+    half, door = width / 2, 900
+    walls = [(-length / 2, -half, -length / 2, half), (length / 2, -half, length / 2, half)]
+    stops = np.linspace(-length / 2, length / 2, doors + 2)
+    for a, b in zip(stops[:-1], stops[1:]):
+        walls.append((a, half, b - door, half))
+        walls.append((a + door, -half, b, -half))
+    return Scene(walls)
+
+
+def cluttered_room(
+    width: float, height: float, obstacles: int, rng: np.random.Generator
+) -> Scene:
+    scene = rectangular_room(width, height)
+    for _ in range(obstacles):
+        x = rng.uniform(-width / 2 + 400, width / 2 - 400)
+        y = rng.uniform(-height / 2 + 400, height / 2 - 400)
+        # Keep the middle clear for the observer.
+        if math.hypot(x, y) < 600:
+            continue
+        scene.obstacles.append((x, y, rng.uniform(50, 300)))
+    return scene
+
+
+def cast_scan(
+    scene: Scene,
+    rng: np.random.Generator,
+    observer: tuple[float, float] = (0, 0),
+    samples: int = 720,
+    noise: float = 15,
+    dropout: float = 0.02,
+    timestamp: int = 0,
+) -> g2.LaserScan:
+    # One revolution of `scene` from `observer`, with Gaussian range noise and missed returns.
+    ox, oy = observer
+    radians = np.arange(samples) * (2 * math.pi / samples)
+    dx, dy = np.cos(radians)[:, None], np.sin(radians)[:, None]
+    ranges = np.full(samples, np.inf)
+
+    if scene.walls:
+        walls = np.array(scene.walls, dtype=np.float64)
+        x0, y0 = walls[:, 0] - ox, walls[:, 1] - oy
+        ex, ey = walls[:, 2] - walls[:, 0], walls[:, 3] - walls[:, 1]
+        # Solve origin + t * (dx, dy) == (x0, y0) + u * (ex, ey) for every beam and wall.
+        denominator = dx * ey - dy * ex
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (x0 * ey - y0 * ex) / denominator
+            u = (x0 * dy - y0 * dx) / denominator
+        t = np.where((t > 0) & (u >= 0) & (u <= 1), t, np.inf)
+        ranges = np.minimum(ranges, t.min(axis=1))
+
+    if scene.obstacles:
+        obstacles = np.array(scene.obstacles, dtype=np.float64)
+        cx, cy, r = obstacles[:, 0] - ox, obstacles[:, 1] - oy, obstacles[:, 2]
+        along = dx * cx + dy * cy
+        squared = along * along - (cx * cx + cy * cy - r * r)
+        with np.errstate(invalid="ignore"):
+            t = along - np.sqrt(squared)
+        t = np.where((squared >= 0) & (t > 0), t, np.inf)
+        ranges = np.minimum(ranges, t.min(axis=1))
+
+    distances = ranges + rng.normal(0, noise, samples)
+    distances = np.where(np.isfinite(ranges), distances, 0)
+    distances[rng.random(samples) < dropout] = 0
+    distances = np.clip(np.rint(distances), 0, (1 << g2.DISTANCE_BITS) - 1).astype(np.int64)
+    return g2.LaserScan(radians, distances, timestamp)
+
+
+def encode_revolution(scan: g2.LaserScan, packets_per_revolution: int = 12) -> bytes:
+    # One revolution of `scan` the way G2 streams it: a single-sample START_DATA packet,
+    # followed by cloud packets. Sample i of a packet is decoded at
+    # start + (i + 1) * span / (quantity + 1), hence a step of margin on both ends.
+    stream = bytearray(encode_packet(g2.START_DATA, 0, 0, [0]))
+    degrees = np.degrees(scan.radians)
+    step = 360 / len(scan)
+    for chunk in np.array_split(np.arange(len(scan)), packets_per_revolution):
+        start = math.fmod(degrees[chunk[0]] - step + 360, 360)
+        end = math.fmod(degrees[chunk[-1]] + step, 360)
+        stream += encode_packet(g2.CLOUD_DATA, start, end, scan.distances[chunk].tolist())
+    return bytes(stream)
+
+
+def g2_revolutions(
+    revolutions: int,
+    samples_per_packet: int = 40,
+    packets_per_revolution: int = 12,
+    scene: Optional[Scene] = None,
+    rng: Optional[np.random.Generator] = None,
+) -> bytes:
+    # Encodes `revolutions` full turns of `scene`, a 6 x 4.5 m room by default.
+    scene = scene or rectangular_room(6000, 4500)
+    rng = rng or np.random.default_rng(0)
+    samples = samples_per_packet * packets_per_revolution
+    return b"".join(
+        encode_revolution(cast_scan(scene, rng, samples=samples), packets_per_revolution)
+        for _ in range(revolutions)
+    )
@@ -0,0 +1,159 @@
+from dataclasses import dataclass
+from typing import Final, Optional
+
+import numpy as np
+import struct
+
+# Byte sequence constant.
+SCAN_HEADER_BYTES: Final[bytes] = bytes([0xAA, 0x55])
+
+# Packet layout constants.
+# Header is PH(2), CT(1), LSN(1), FSA(2), LSA(2), CS(2), all little-endian.
+PACKET_HEADER = struct.Struct("<2sBBHHH")
+# Each sample is an intensity byte followed by a 16-bit distance word.
+PACKET_SAMPLE = struct.Struct("<BH")
+# Same sample layout, for decoding a whole payload at once.
+SAMPLE_DTYPE = np.dtype([("intensity", "u1"), ("word", "<u2")])
+
+# Size of the ring buffer holding undecoded bytes.
+RING_CAPACITY: Final[int] = 1 << 16
+
+
+@dataclass
+class RawPacket:
+    status: int
+    quantity: int
+    fsa: int
+    lsa: int
+    check_code: int
+    payload: bytes
+
+
+def packet_checksum(status: int, quantity: int, fsa: int, lsa: int, payload) -> int:
+    # https://www.ydlidar.com/Public/upload/files/2022-06-21/YDLIDAR%20G2%20Development%20Manual%20V1.7.pdf
+    # XOR over the 16-bit words of the packet, with intensity bytes taken on their own.
+    samples = np.frombuffer(payload, dtype=SAMPLE_DTYPE, count=quantity)
+    check = 0x55AA ^ fsa ^ lsa ^ (status | (quantity << 8))
+    check ^= int(np.bitwise_xor.reduce(samples["intensity"], initial=0))
+    check ^= int(np.bitwise_xor.reduce(samples["word"], initial=0))
+    return check
+
+
+class PacketFramer:
+    # Cuts a raw G2 byte stream into checksum-verified packets.
+    # Undecoded bytes live in a fixed ring of `capacity` bytes, kept contiguous in _ring[_start:_end]
+    # so the header search can run over it in one go.
+    capacity: int
+    packets: int
+    dropped_bytes: int
+    dropped_packets: int
+
+    def __init__(self, capacity: int = RING_CAPACITY) -> None:
+        self.capacity = capacity
+        self._ring = np.zeros(capacity, dtype=np.uint8)
+        self._start = 0
+        self._end = 0
+        self._missing = 1
+
+        self.packets = 0
+        self.dropped_bytes = 0
+        self.dropped_packets = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    @property
+    def missing(self) -> int:
+        # At least this many bytes must be fed before next_packet() can make progress.
+        return max(self._missing - len(self), 1)
+
+    def reset(self) -> None:
+        self._start = 0
+        self._end = 0
+        self._missing = 1
+
+    def feed(self, data: bytes) -> None:
+        incoming = np.frombuffer(data, dtype=np.uint8)
+
+        # Never keep more than the ring can hold; the oldest bytes are sacrificed first.
+        overflow = len(self) + len(incoming) - self.capacity
+        if overflow > 0:
+            skipped = min(overflow, len(self))
+            self._start += skipped
+            self.dropped_bytes += overflow
+            incoming = incoming[overflow - skipped :]
+
+        if self._end + len(incoming) > self.capacity:
+            pending = len(self)
+            self._ring[:pending] = self._ring[self._start : self._end]
+            self._start, self._end = 0, pending
+
+        self._ring[self._end : self._end + len(incoming)] = incoming
+        self._end += len(incoming)
+
+    def take(self, size: int) -> Optional[bytes]:
+        # Raw bytes that aren't part of a packet, such as a command response.
+        if len(self) < size:
+            self._missing = size
+            return None
+        data = self._ring[self._start : self._start + size].tobytes()
+        self._start += size
+        return data
+
+    def next_packet(self) -> Optional[RawPacket]:
+        # Returns None when more bytes have to be fed first.
+        while True:
+            if not self._align():
+                return None
+
+            if len(self) < PACKET_HEADER.size:
+                self._missing = PACKET_HEADER.size
+                return None
+
+            _, status, quantity, fsa, lsa, check_code = PACKET_HEADER.unpack_from(
+                self._ring, self._start
+            )
+            size = PACKET_HEADER.size + quantity * PACKET_SAMPLE.size
+            if len(self) < size:
+                self._missing = size
+                return None
+
+            payload_start = self._start + PACKET_HEADER.size
+            payload = self._ring[payload_start : self._start + size]
+            if packet_checksum(status, quantity, fsa, lsa, payload) != check_code:
+                # Most likely a header look-alike, or corrupted on the way.
+                # Only skip the header, as the real next packet could start within this one.
+                self.dropped_packets += 1
+                self.dropped_bytes += len(SCAN_HEADER_BYTES)
+                self._start += len(SCAN_HEADER_BYTES)
+                continue
+
+            self._start += size
+            self._missing = 1
+            self.packets += 1
+            return RawPacket(status, quantity, fsa, lsa, check_code, payload.tobytes())
+
+    def _align(self) -> bool:
+        # Moves _start onto the next packet header, dropping anything before it.
+        window = self._ring[self._start : self._end]
+        if len(window) < 2:
+            self._missing = 2
+            return False
+        if window[0] == SCAN_HEADER_BYTES[0] and window[1] == SCAN_HEADER_BYTES[1]:
+            return True
+
+        found = np.flatnonzero(
+            (window[:-1] == SCAN_HEADER_BYTES[0]) & (window[1:] == SCAN_HEADER_BYTES[1])
+        )
+        if len(found) > 0:
+            skipped = int(found[0])
+        else:
+            # Keep the last byte, it may be the first half of a header.
+            skipped = len(window) - 1 if window[-1] == SCAN_HEADER_BYTES[0] else len(window)
+
+        self.dropped_bytes += skipped
+        self._start += skipped
+        if len(found) == 0:
+            self._missing = 2
+            return False
+        return True
@@ -1,9 +1,16 @@
 import serial
-from typing import Final, List
+import threading
+from collections import deque
+from typing import Final, Iterator, List, Optional
 from typing import Tuple
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 
 import math
+import numpy as np
+
+from lidar.framing import PacketFramer, RawPacket
+from lidar.framing import PACKET_SAMPLE, SAMPLE_DTYPE
+from measurement import clock
 
 # Byte sequence constant.
 SCAN_HEADER = (bytes([0xAA]), bytes([0x55]))
@@ -20,6 +27,24 @@ START_DATA: Final[int] = 1
 MIN_RANGE: Final[int] = 120
 MAX_RANGE: Final[int] = 16000
 
+# Size of the response G2 sends back to START_SCAN.
+RESPONSE_SIZE: Final[int] = 7
+
+# How many bytes we try to pull from the port at once.
+READ_CHUNK_SIZE: Final[int] = 4096
+
+# How many completed revolutions a stream keeps before dropping the oldest.
+STREAM_CAPACITY: Final[int] = 4
+
+# Distances are 14-bit wide, so the angle correction of every possible distance is tabulated once.
+DISTANCE_BITS: Final[int] = 14
+_TABLE_DISTANCES = np.arange(1 << DISTANCE_BITS, dtype=np.float64)
+ANGLE_CORRECTION_TABLE = np.where(
+    _TABLE_DISTANCES == 0,
+    0.0,
+    np.arctan2(21.8 * (155.3 - _TABLE_DISTANCES), 155.3 * _TABLE_DISTANCES),
+)
+
 
 @dataclass
 class LaserScanPoint:
@@ -27,6 +52,69 @@ class LaserScanPoint:
     distance: int
 
 
+@dataclass
+class LaserScan:
+    # One revolution as parallel arrays, instead of one LaserScanPoint per sample.
+    # timestamp is the clock.now() at which the revolution was completed. heading is the yaw of
+    # the observer at that time in radians, when known, see pose.heading.HeadingTracker.
+    # sample_times holds the clock.now() at which every sample was taken, when known.
+    radians: np.ndarray
+    distances: np.ndarray
+    timestamp: int = 0
+    heading: Optional[float] = None
+    sample_times: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_points(cls, points: List[LaserScanPoint], timestamp: int = 0) -> "LaserScan":
+        radians = np.fromiter((p.radian for p in points), dtype=np.float64, count=len(points))
+        distances = np.fromiter((p.distance for p in points), dtype=np.int64, count=len(points))
+        return cls(radians, distances, timestamp)
+
+    def __len__(self) -> int:
+        return len(self.distances)
+
+    def to_points(self) -> List[LaserScanPoint]:
+        return [
+            LaserScanPoint(r, d) for r, d in zip(self.radians.tolist(), self.distances.tolist())
+        ]
+
+    def gate(self, min_range: int = MIN_RANGE, max_range: int = MAX_RANGE) -> "LaserScan":
+        # Drops the returns G2 can't measure, zero distances of missed returns included.
+        kept = (self.distances >= min_range) & (self.distances <= max_range)
+        return self._select(kept)
+
+    def downsample_angular(self, bin_width: float) -> "LaserScan":
+        # Keeps the closest return within every `bin_width` radians.
+        bins = np.floor(self.radians / bin_width).astype(np.int64)
+        return self._select(self._closest_per_key(bins))
+
+    def downsample_voxel(self, size: float) -> "LaserScan":
+        # Keeps the closest return within every `size` x `size` mm cell of the plane.
+        xs, ys = self.to_cartesian()
+        cells = np.stack([np.floor(xs / size), np.floor(ys / size)], axis=1).astype(np.int64)
+        _, keys = np.unique(cells, axis=0, return_inverse=True)
+        return self._select(self._closest_per_key(keys.reshape(-1)))
+
+    def to_cartesian(self) -> Tuple[np.ndarray, np.ndarray]:
+        # (x, y) in mm, with the sensor at the origin.
+        return self.distances * np.cos(self.radians), self.distances * np.sin(self.radians)
+
+    def _closest_per_key(self, keys: np.ndarray) -> np.ndarray:
+        # Indices of the closest return for every distinct key, in scan order.
+        order = np.lexsort((self.distances, keys))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = keys[order][1:] != keys[order][:-1]
+        return np.sort(order[first])
+
+    def _select(self, selection: np.ndarray) -> "LaserScan":
+        return replace(
+            self,
+            radians=self.radians[selection],
+            distances=self.distances[selection],
+            sample_times=None if self.sample_times is None else self.sample_times[selection],
+        )
+
+
 @dataclass
 class ScanHeader:
     frequency: float
@@ -37,117 +125,266 @@ class ScanHeader:
     check_code: int
 
 
+class ScanRing:
+    # Bounded queue of completed revolutions, filled by the stream reader thread.
+    # When consumers fall behind, the oldest revolution is dropped and counted as an overrun.
+    capacity: int
+    overruns: int
+
+    def __init__(self, capacity: int = STREAM_CAPACITY) -> None:
+        if capacity < 1:
+            raise ValueError("Capacity cannot be less than 1.")
+        self.capacity = capacity
+        self.overruns = 0
+        self._scans = deque(maxlen=capacity)
+        self._latest = None
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+
+    def put(self, scan) -> None:
+        with self._condition:
+            if len(self._scans) == self.capacity:
+                self.overruns = self.overruns + 1
+            self._scans.append(scan)
+            self._latest = scan
+            self._condition.notify()
+
+    def get(self, timeout: Optional[float] = None):
+        # Returns the oldest pending revolution, or None once the ring is closed and drained.
+        with self._condition:
+            self._condition.wait_for(lambda: self._scans or self._closed, timeout)
+            if self._scans:
+                return self._scans.popleft()
+            if self._error is not None:
+                raise self._error
+            if not self._closed:
+                raise TimeoutError("No revolution arrived in time.")
+            return None
+
+    def latest(self):
+        # Most recently completed revolution, whether or not it was consumed already.
+        with self._condition:
+            if self._error is not None:
+                raise self._error
+            return self._latest
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        with self._condition:
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def __iter__(self) -> Iterator:
+        while True:
+            scan = self.get()
+            if scan is None:
+                return
+            yield scan
+
+
 class G2:
     _serial: serial.Serial
+    framer: PacketFramer
+    _ring: Optional[ScanRing]
+    _reader: Optional[threading.Thread]
+
+    def __init__(self, port, transport: Optional[serial.Serial] = None):
+        # Anything that behaves like serial.Serial (read, write, in_waiting) can stand in for the port.
+        if transport is None:
+            transport = open_port(port)
+        self._serial = transport
+
+        # Bytes pulled from the port but not parsed yet live in the framer.
+        # Its counters tell how many bytes and packets were dropped to corruption.
+        self.framer = PacketFramer()
+
+        self._ring = None
+        self._reader = None
+        self._streaming = threading.Event()
+        # When the previous revolution was completed, to time the next one.
+        self._last_completed: Optional[int] = None
+
+    def read_data_once(self, after_iteration=0, as_arrays=False):
+        # With as_arrays, a cycle comes back as a LaserScan instead of a list of points.
+        parse = self._parse_one_cycle_arrays if as_arrays else self._parse_one_cycle
 
-    def __init__(self, port):
-        self._serial = serial.Serial(port, 230400, timeout=2, write_timeout=2)
-
-    def read_data_once(self, after_iteration=0):
         self._start_scan()
         self._parse_response()
 
         current_iteration: int = 0
-        retrieved: List[LaserScanPoint]
 
         # Wait until it reaches to specified cycle.
-        retrieved = self._parse_one_cycle()
+        retrieved = parse()
         while current_iteration < after_iteration:
             current_iteration = current_iteration + 1
-            retrieved = self._parse_one_cycle()
+            retrieved = parse()
 
         self._stop_scan()
         return retrieved
 
+    def start_stream(
+        self, capacity=STREAM_CAPACITY, as_arrays=False, warmup=0
+    ) -> ScanRing:
+        # Keeps the motor spinning and decodes revolutions on a background thread,
+        # so callers no longer pay for spin-up on every scan.
+        if self._reader is not None:
+            raise RuntimeError("G2 is already streaming.")
+
+        parse = self._parse_one_cycle_arrays if as_arrays else self._parse_one_cycle
+        self._ring = ScanRing(capacity)
+        self._streaming.set()
+
+        self._start_scan()
+        self._parse_response()
+
+        self._reader = threading.Thread(
+            target=self._stream_loop, args=(parse, warmup), daemon=True
+        )
+        self._reader.start()
+        return self._ring
+
+    def stop_stream(self) -> None:
+        if self._reader is None:
+            return
+
+        self._streaming.clear()
+        self._reader.join()
+        self._reader = None
+        self._stop_scan()
+
+    def scans(self, timeout: Optional[float] = None) -> Iterator:
+        # Yields every revolution kept by the stream, in order, until it's stopped.
+        if self._ring is None:
+            raise RuntimeError("G2 is not streaming.")
+        while True:
+            scan = self._ring.get(timeout)
+            if scan is None:
+                return
+            yield scan
+
+    def latest_scan(self):
+        if self._ring is None:
+            raise RuntimeError("G2 is not streaming.")
+        return self._ring.latest()
+
+    @property
+    def overruns(self) -> int:
+        return 0 if self._ring is None else self._ring.overruns
+
+    def _stream_loop(self, parse, warmup: int):
+        ring = self._ring
+        try:
+            # Throw away the revolutions while the motor is still spinning up.
+            for _ in range(warmup):
+                parse()
+            while self._streaming.is_set():
+                ring.put(parse())
+        except BaseException as e:
+            ring.close(e)
+            return
+        ring.close()
+
     def _parse_response(self):
         # Do not delete this even they look not useful.
         # We need to at least 'pop out' data from serial so we can ensure get correct data afterwards.
-        start_sign = self._serial.read(2)
-        response = self._serial.read(4)
-        typecode = self._serial.read()
+        # start sign(2), response(4) and typecode(1).
+        while self.framer.take(RESPONSE_SIZE) is None:
+            self._fill()
 
     def _start_scan(self):
+        # Whatever is left from the previous scan is stale now.
+        self.framer.reset()
         self._serial.write(START_SCAN)
 
     def _stop_scan(self):
         self._serial.write(STOP_SCAN)
 
     def _parse_one_cycle(self) -> List[LaserScanPoint]:
-        header_count: int = 0
         scanned_points: List[LaserScanPoint] = []
+        for header, payload in self._cycle_packets():
+            scanned_points.extend(self._parse_scan_samples(header, payload))
+
+        return scanned_points
+
+    def _parse_one_cycle_arrays(self) -> LaserScan:
+        packets = list(self._cycle_packets())
+        completed = clock.now()
+        decoded = [decode_samples_array(h, p) for h, p in packets]
+        radians = np.concatenate([r for r, _ in decoded])
+        distances = np.concatenate([d for _, d in decoded]).astype(np.int64)
+        sample_times = self._sample_times([h for h, _ in packets], completed)
+        return LaserScan(radians, distances, completed, sample_times=sample_times)
+
+    def _sample_times(self, headers: List[ScanHeader], completed: int) -> Optional[np.ndarray]:
+        # The G2 turns at a steady rate, so every sample was taken the share of a turn between
+        # its angle and the last sample's before the revolution completed. Start packets report
+        # the scan frequency, otherwise the time since the previous revolution is used.
+        frequency = max((h.frequency for h in headers if h.packet_type == START_DATA), default=0)
+        if frequency > 0:
+            period = clock.NS_PER_SECOND / frequency
+        elif self._last_completed is not None:
+            period = completed - self._last_completed
+        else:
+            period = None
+        self._last_completed = completed
+        if period is None:
+            return None
+
+        # Mechanical angles, before the correction by distance, unwrapped across 0.
+        angles = np.unwrap(np.concatenate([sample_angles(h) for h in headers]), period=360)
+        return completed - np.rint((angles[-1] - angles) / 360 * period).astype(np.int64)
+
+    def _cycle_packets(self):
         is_first_header: bool = True
 
         # Loop before the end of a cycle
         while True:
-            # detect if this is one of the correct fragment of scan header
-            received = self._serial.read()
-            if received == SCAN_HEADER[header_count]:
-                header_count = header_count + 1
-            if header_count < 2:
-                continue
-
-            header = self._parse_scan_header_fields()
-            parsed_points = self._parse_scan_samples(header)
-            scanned_points.extend(parsed_points)
+            header, payload = self._next_packet()
+            yield header, payload
 
             if not is_first_header and header.packet_type == START_DATA:
                 break
 
             is_first_header = False
-            header_count = 0
 
-        return scanned_points
+    def _next_packet(self) -> Tuple[ScanHeader, bytes]:
+        # The framer only hands out packets whose checksum matches, realigning on its own
+        # when bytes get lost or corrupted.
+        packet = self.framer.next_packet()
+        while packet is None:
+            self._fill()
+            packet = self.framer.next_packet()
 
-    def _parse_scan_header_fields(self) -> ScanHeader:
-        # This assumes incoming serial data is aligned correctly.
-        # If failed, this does not yield correct results anymore.
-        status = self._serial.read()
-        sample_quantity = self._serial.read()
-        fsa_angle = self._serial.read(2)
-        lsa_angle = self._serial.read(2)
-        check_code = self._serial.read(2)
-
-        status = int.from_bytes(status, "little")
-        frequency = (status >> 1) / 10
-        packet_type = status & 0b1
-        quantity = int.from_bytes(sample_quantity, "little")
-        fsa = int.from_bytes(fsa_angle, "little")
-        lsa = int.from_bytes(lsa_angle, "little")
-
-        check_code = int.from_bytes(check_code, "little")
-
-        starting_angle = (fsa >> 1) / 64
-        ending_angle = (lsa >> 1) / 64
-        angle_diff = (
-            (ending_angle + 360) - starting_angle
-            if ending_angle - starting_angle < 0
-            else ending_angle - starting_angle
-        )
+        return self._parse_scan_header_fields(packet), packet.payload
+
+    def _parse_scan_header_fields(self, packet: RawPacket) -> ScanHeader:
+        frequency = (packet.status >> 1) / 10
+        packet_type = packet.status & 0b1
+        starting_angle = (packet.fsa >> 1) / 64
+        ending_angle = (packet.lsa >> 1) / 64
 
         header_field = ScanHeader(
-            frequency, packet_type, quantity, starting_angle, ending_angle, check_code
+            frequency,
+            packet_type,
+            packet.quantity,
+            starting_angle,
+            ending_angle,
+            packet.check_code,
         )
         return header_field
 
-    def _parse_scan_samples(self, header: ScanHeader) -> List[LaserScanPoint]:
-        # This assumes incoming serial data is aligned correctly.
-        # If failed, this does not yield correct results anymore.
-        samples = []
-        for i in range(0, header.quantity):
-            sample_data = self._serial.read(3)
-            sample_data = int.from_bytes(sample_data, "little")
-
-            second_byte = (sample_data >> 8) & 0b11111111
-            third_byte = (sample_data >> 16) & 0b11111111
+    def _parse_scan_samples(
+        self, header: ScanHeader, payload: bytes
+    ) -> List[LaserScanPoint]:
+        angle_step = _angle_step(header)
 
-            angle_diff = (
-                (header.end_angle + 360) - header.start_angle
-                if header.end_angle - header.start_angle < 0
-                else header.end_angle - header.start_angle
-            )
-            distance = (third_byte << 6) + (second_byte >> 2)
+        samples = []
+        for i, (_, word) in enumerate(PACKET_SAMPLE.iter_unpack(payload)):
+            # Lower 2 bits of the distance word are flags, the rest is distance in mm.
+            distance = word >> 2
 
-            angle = angle_diff / (header.quantity + 1) * (i + 1) + header.start_angle
+            angle = angle_step * (i + 1) + header.start_angle
             correcting_angle = (
                 0
                 if distance == 0
@@ -158,3 +395,38 @@ class G2:
 
             samples.append(LaserScanPoint(final_radian, distance))
         return samples
+
+    def _fill(self):
+        # Reading whatever the port already holds keeps the number of read calls per packet low.
+        wanted = max(self.framer.missing, min(self._serial.in_waiting, READ_CHUNK_SIZE))
+        chunk = self._serial.read(wanted)
+        if not chunk:
+            raise TimeoutError("G2 did not send any data in time.")
+        self.framer.feed(chunk)
+
+
+def open_port(port) -> serial.Serial:
+    return serial.Serial(port, 230400, timeout=2, write_timeout=2)
+
+
+def decode_samples_array(header: ScanHeader, payload: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    # Vectorized counterpart of G2._parse_scan_samples, yielding (radians, distances) of a packet.
+    samples = np.frombuffer(payload, dtype=SAMPLE_DTYPE, count=header.quantity)
+    distances = samples["word"] >> 2
+
+    final_angles = np.fmod(sample_angles(header) + ANGLE_CORRECTION_TABLE[distances], 360)
+    return np.radians(final_angles), distances
+
+
+def sample_angles(header: ScanHeader) -> np.ndarray:
+    # Angles in degrees the samples of a packet were taken at, before the correction by distance.
+    return _angle_step(header) * np.arange(1, header.quantity + 1) + header.start_angle
+
+
+def _angle_step(header: ScanHeader) -> float:
+    angle_diff = (
+        (header.end_angle + 360) - header.start_angle
+        if header.end_angle - header.start_angle < 0
+        else header.end_angle - header.start_angle
+    )
+    return angle_diff / (header.quantity + 1)
@@ -0,0 +1,144 @@
+# Capture and replay of the raw G2 byte stream, so the decoder and mapper can run without the robot.
+#
+# Capture: python -m lidar.replay PORT OUTPUT [REVOLUTIONS]
+from lidar import g2
+from typing import BinaryIO, Final, List, Tuple
+
+import bisect
+import struct
+import sys
+import time
+
+# File layout: MAGIC, then records of RECORD header followed by `length` bytes of data.
+MAGIC: Final[bytes] = b"G2RAW\x01"
+# Nanoseconds since capture started, direction and length.
+RECORD = struct.Struct("<QBI")
+
+# Direction constants.
+RECEIVED: Final[int] = 0
+SENT: Final[int] = 1
+
+
+class CaptureTransport:
+    # Wraps a serial port and writes every byte that goes through it, with its timestamp.
+    def __init__(self, transport, path: str) -> None:
+        self._transport = transport
+        self._file: BinaryIO = open(path, "wb")
+        self._file.write(MAGIC)
+        self._started = time.monotonic_ns()
+
+    @property
+    def in_waiting(self) -> int:
+        return self._transport.in_waiting
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._transport.read(size)
+        if data:
+            self._record(RECEIVED, data)
+        return data
+
+    def write(self, data) -> int:
+        self._record(SENT, bytes(data))
+        return self._transport.write(data)
+
+    def close(self) -> None:
+        self._file.close()
+        self._transport.close()
+
+    def _record(self, direction: int, data: bytes) -> None:
+        elapsed = time.monotonic_ns() - self._started
+        self._file.write(RECORD.pack(elapsed, direction, len(data)))
+        self._file.write(data)
+
+
+def load_capture(path: str) -> List[Tuple[int, bytes]]:
+    # Returns (timestamp in ns, data) of every received chunk in the capture.
+    with open(path, "rb") as f:
+        content = f.read()
+
+    if not content.startswith(MAGIC):
+        raise ValueError(f"{path} is not a G2 capture.")
+
+    chunks = []
+    offset = len(MAGIC)
+    while offset < len(content):
+        elapsed, direction, length = RECORD.unpack_from(content, offset)
+        offset += RECORD.size
+        if direction == RECEIVED:
+            chunks.append((elapsed, content[offset : offset + length]))
+        offset += length
+    return chunks
+
+
+class ReplayTransport:
+    # Plays a capture back in place of serial.Serial.
+    # With realtime, bytes become readable at the pace they were recorded; otherwise all at once.
+    def __init__(self, path: str, realtime: bool = False) -> None:
+        chunks = load_capture(path)
+        self._data = b"".join(data for _, data in chunks)
+
+        # _received[i] bytes in total have arrived by _timestamps[i].
+        self._timestamps: List[int] = []
+        self._received: List[int] = []
+        for elapsed, data in chunks:
+            self._timestamps.append(elapsed)
+            self._received.append(len(data) + (self._received[-1] if self._received else 0))
+
+        self.realtime = realtime
+        self._position = 0
+        self._started = time.monotonic_ns()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def in_waiting(self) -> int:
+        return self._arrived() - self._position
+
+    def read(self, size: int = 1) -> bytes:
+        end = min(self._position + size, len(self._data))
+        if self.realtime:
+            self._wait_until(end)
+
+        chunk = self._data[self._position : end]
+        self._position = end
+        return chunk
+
+    def write(self, data) -> int:
+        # Commands have no effect on a recording.
+        return len(data)
+
+    def rewind(self) -> None:
+        self._position = 0
+        self._started = time.monotonic_ns()
+
+    def close(self) -> None:
+        pass
+
+    def _arrived(self) -> int:
+        if not self.realtime:
+            return len(self._data)
+
+        elapsed = time.monotonic_ns() - self._started
+        index = bisect.bisect_right(self._timestamps, elapsed)
+        return self._received[index - 1] if index > 0 else 0
+
+    def _wait_until(self, end: int) -> None:
+        index = bisect.bisect_left(self._received, end)
+        if index == len(self._received):
+            return
+
+        remaining = self._timestamps[index] - (time.monotonic_ns() - self._started)
+        if remaining > 0:
+            time.sleep(remaining / 1e9)
+
+
+if __name__ == "__main__":
+    port, output = sys.argv[1], sys.argv[2]
+    revolutions = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    transport = CaptureTransport(g2.open_port(port), output)
+    lidar = g2.G2(port, transport)
+    lidar.read_data_once(revolutions)
+    transport.close()
+    print(f"Captured {revolutions} revolutions into {output}.")
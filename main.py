@@ -1,11 +1,18 @@
 from lidar import g2
+from mapper import mapfile
 from mapper import mapper
+from mapper import matcher
+from mapper import pipeline
+from mapper import viewer
 from typing import List
-from mapper.mapper import Point
-from measurement import timer
+from measurement import profiler
+from pose import accel_sensor
+from pose import heading
 from PIL import Image
 
+import itertools
 import matplotlib.pyplot as plt
+import numpy as np
 
 
 def visualize_scan_points(scanned_data: List[g2.LaserScanPoint]):
@@ -22,42 +29,69 @@ def visualize_scan_points(scanned_data: List[g2.LaserScanPoint]):
     ax.scatter(radians, dist, s=0.1)
     plt.show()
 
-def visualize_occupancy_grid(grid: List[List[int]]):
-    plt.imshow(grid, cmap="binary", vmin=0, vmax=255)
-    plt.draw()
-    plt.pause(0.16)
 
+def create_grayscale_bitmap(grid: np.ndarray):
+    # One copy straight from the grid buffer, cells are already 8-bit gray levels.
+    Image.fromarray(grid).save("grayscale_bitmap.bmp")
 
-def serialize(grid: list[list[int]]):
-    with open("map.bin", "wb") as f:
-        for row in grid:
-            f.write(bytes(row))
 
+RESOLUTION = 18
+SCAN_COUNT = 5
 
-def create_grayscale_bitmap(grid: list[list[int]]):
-    height = len(grid)
-    width = len(grid[0])
-    img = Image.new("L", (width, height))
 
-    for y in range(height):
-        for x in range(width):
-            img.putpixel((x, y), grid[y][x])
+def report_match(global_mapper: mapper.GlobalMapper, scan: g2.LaserScan):
+    # The observer pose is estimated by matching the scan against the map.
+    if global_mapper.last_match is not None:
+        match = global_mapper.last_match
+        print(f"Matched {match.pose} (score {match.score:.2f}) in {match.elapsed_ns / 1e6:.1f} ms")
 
-    img.save("grayscale_bitmap.bmp")
 
+def on_update(global_mapper: mapper.GlobalMapper, scan: g2.LaserScan):
+    report_match(global_mapper, scan)
+    map_viewer.publish(global_mapper)
 
-port = input("Enter port: ")
-g2_lidar = g2.G2(port)
 
-submapper = mapper.Submapper(18)
-global_mapper = mapper.GlobalMapper((250, 250))
+# Submap workers import this module, so only run when started as the program.
+if __name__ == "__main__":
+    profiler.enable()
 
-for i in range(0, 5):
-    scanned_data = g2_lidar.read_data_once(10)
-    submap = submapper.lidar_to_submap(scanned_data)
-    global_mapper.update(submap)
-    global_mapper.update_observer_pos(Point(i, 0))
-    visualize_occupancy_grid(global_mapper._occupancy_grid.content)
+    port = input("Enter port: ")
+    g2_lidar = g2.G2(port)
 
-serialize(global_mapper._occupancy_grid.content)
-create_grayscale_bitmap(global_mapper._occupancy_grid.content)
+    global_mapper = mapper.GlobalMapper((250, 250), matcher.ScanMatcher(RESOLUTION))
+
+    # The map is drawn by its own process.
+    map_viewer = viewer.MapViewer()
+    map_viewer.start()
+
+    # The IMU yaw, on the same clock as the LiDAR, gives every revolution its heading and undoes
+    # the turns taken while it was being scanned.
+    heading_tracker = heading.HeadingTracker()
+    imu_sampler = accel_sensor.MPU9250Sampler(
+        accel_sensor.MPU9250(), fifo=True, consumer=heading_tracker.add_samples
+    )
+    imu_sampler.start()
+
+    # Keep the LiDAR spinning for the whole run instead of restarting it on every scan.
+    # Acquisition, submapping and fusion run as separate stages.
+    g2_lidar.start_stream(as_arrays=True, warmup=10)
+    runtime = pipeline.MappingPipeline(
+        map(heading_tracker.deskew, itertools.islice(g2_lidar.scans(), SCAN_COUNT)),
+        global_mapper,
+        RESOLUTION,
+        on_update=on_update,
+    )
+    runtime.run()
+    g2_lidar.stop_stream()
+    imu_sampler.stop()
+
+    # Tiled and compressed, reopen it with mapfile.load_global_map() to continue mapping.
+    mapfile.save_global_map("map.dmap", global_mapper, RESOLUTION)
+    create_grayscale_bitmap(global_mapper.get_occupancy_grid().content)
+
+    print(runtime.to_table())
+    print(profiler.to_table())
+
+    # Leave the final map on screen until its window is closed.
+    map_viewer.join()
+    map_viewer.close()
@@ -1,6 +1,8 @@
 from typing import List
 from typing import Tuple
 
+import numpy as np
+
 
 # https://www.roguebasin.com/index.php/Bresenham%27s_Line_Algorithm
 def bresenham(x0: int, x1: int, y0: int, y1: int) -> List[Tuple[int, int]]:
@@ -45,3 +47,46 @@ def bresenham(x0: int, x1: int, y0: int, y1: int) -> List[Tuple[int, int]]:
     if swapped:
         points.reverse()
     return points
+
+
+# Vectorized bresenham() over N segments at once.
+# Returns the cells of every segment concatenated as (xs, ys), each segment in the same order
+# bresenham() yields it, plus N + 1 offsets so that segment i is xs[offsets[i]:offsets[i + 1]].
+def bresenham_batch(
+    x0: np.ndarray, x1: np.ndarray, y0: np.ndarray, y1: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    x0, x1 = np.asarray(x0, dtype=np.int64), np.asarray(x1, dtype=np.int64)
+    y0, y1 = np.asarray(y0, dtype=np.int64), np.asarray(y1, dtype=np.int64)
+
+    # Walk along the major axis, a, stepping the minor axis, b, when needed.
+    is_steep = np.abs(y1 - y0) > np.abs(x1 - x0)
+    a0, a1 = np.where(is_steep, y0, x0), np.where(is_steep, y1, x1)
+    b0, b1 = np.where(is_steep, x0, y0), np.where(is_steep, x1, y1)
+
+    # Swap start and end points if necessary and store swap state
+    swapped = a0 > a1
+    a0, a1 = np.where(swapped, a1, a0), np.where(swapped, a0, a1)
+    b0, b1 = np.where(swapped, b1, b0), np.where(swapped, b0, b1)
+
+    da = a1 - a0
+    db = np.abs(b1 - b0)
+    bstep = np.where(b0 < b1, 1, -1)
+
+    counts = da + 1
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Step k of every segment, reversed for swapped ones, as bresenham() reverses them.
+    segment = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(offsets[-1]) - offsets[segment]
+    k = np.where(swapped[segment], counts[segment] - 1 - k, k)
+
+    # bresenham() keeps error = da // 2 - k * db + da * m in [0, da), m being how many times
+    # b has stepped so far, so m has a closed form.
+    da_s = da[segment]
+    m = -((da_s // 2 - k * db[segment]) // np.maximum(da_s, 1))
+
+    a = a0[segment] + k
+    b = b0[segment] + bstep[segment] * m
+    steep = is_steep[segment]
+    return np.where(steep, b, a), np.where(steep, a, b), offsets
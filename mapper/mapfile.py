@@ -0,0 +1,253 @@
+from collections.abc import MutableMapping
+from dataclasses import dataclass
+from mapper import mapper
+from typing import Final, Iterator, Optional
+
+import mmap
+import numpy as np
+import os
+import struct
+import zlib
+
+# Map file layout, little endian:
+#   header  MAGIC, version, tile_size, resolution (mm per cell), fill value, bounds (x0, y0,
+#           width, height) of the allocated tiles, observer pose (x, y, heading) and tile count
+#   index   one (tx, ty, offset, length) entry per stored tile, sorted by key
+#   data    every tile as zlib-compressed rows of uint8 cells
+# Tiles holding nothing but the fill value are left out.
+MAGIC: Final[bytes] = b"DLBXMAP\x00"
+VERSION: Final[int] = 1
+MAP_HEADER: Final[struct.Struct] = struct.Struct("<8sHHHBxiiIIiifI")
+INDEX_DTYPE: Final[np.dtype] = np.dtype(
+    [("tx", "<i4"), ("ty", "<i4"), ("offset", "<u8"), ("length", "<u4")]
+)
+COMPRESSION_LEVEL: Final[int] = 6
+
+
+@dataclass
+class MapHeader:
+    version: int
+    tile_size: int
+    resolution: int
+    fill: int
+    bounds: tuple[int, int, int, int]
+    origin: mapper.Pose
+    tile_count: int
+
+
+def save_map(
+    path: str,
+    grid: mapper.TiledMap,
+    resolution: int,
+    origin: Optional[mapper.Pose] = None,
+) -> MapHeader:
+    if grid.dtype != np.uint8:
+        raise ValueError("Only uint8 occupancy grids can be saved.")
+    if origin is None:
+        origin = mapper.Pose(0, 0, 0.0)
+
+    keys = sorted(grid.tiles.keys(), key=lambda k: (k[1], k[0]))
+    chunks = []
+    for key in keys:
+        tile = grid.tiles[key]
+        if (tile == grid.fill).all():
+            continue
+        chunks.append((key, zlib.compress(np.ascontiguousarray(tile).tobytes(), COMPRESSION_LEVEL)))
+
+    bounds = grid.bounds() or (0, 0, 0, 0)
+    x0, y0, x1, y1 = bounds
+    header = MapHeader(
+        VERSION, grid.tile_size, resolution, grid.fill, (x0, y0, x1 - x0, y1 - y0), origin, len(chunks)
+    )
+
+    index = np.zeros(len(chunks), dtype=INDEX_DTYPE)
+    offset = MAP_HEADER.size + index.nbytes
+    for i, ((tx, ty), data) in enumerate(chunks):
+        index[i] = (tx, ty, offset, len(data))
+        offset += len(data)
+
+    # Written aside and moved into place, so that a crash never leaves a truncated map behind.
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(_pack_header(header))
+        f.write(index.tobytes())
+        for _, data in chunks:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    return header
+
+
+class MapFile:
+    # Memory-mapped map file. Opening it only reads the header and the index,
+    # tiles are decompressed when first accessed through tiles().
+    header: MapHeader
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.header = _unpack_header(self._mmap)
+            index = np.frombuffer(
+                self._mmap, INDEX_DTYPE, self.header.tile_count, MAP_HEADER.size
+            )
+        except BaseException:
+            self._file.close()
+            raise
+        self._entries = dict(
+            zip(
+                zip(index["tx"].tolist(), index["ty"].tolist()),
+                zip(index["offset"].tolist(), index["length"].tolist()),
+            )
+        )
+
+    def keys(self):
+        return self._entries.keys()
+
+    def read_tile(self, key: tuple[int, int]) -> np.ndarray:
+        offset, length = self._entries[key]
+        size = self.header.tile_size
+        # Decompressed into a bytearray, so that the tile is writable without another copy.
+        cells = bytearray(zlib.decompress(self._mmap[offset : offset + length]))
+        if len(cells) != size * size:
+            raise ValueError(f"Tile {key} is corrupted.")
+        return np.frombuffer(cells, dtype=np.uint8).reshape(size, size)
+
+    def tiles(self) -> "LazyTiles":
+        return LazyTiles(self)
+
+    def to_tiled_map(self) -> mapper.TiledMap:
+        return mapper.TiledMap(self.header.tile_size, self.header.fill, np.uint8, self.tiles())
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "MapFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class LazyTiles(MutableMapping):
+    # Tile store of a TiledMap over a MapFile. Stored tiles are decompressed on first access
+    # and then kept, along with every tile written since, in memory. The file is never modified.
+    def __init__(self, source: MapFile) -> None:
+        self._source = source
+        self._loaded = {}
+        self._deleted = set()
+
+    def __getitem__(self, key: tuple[int, int]) -> np.ndarray:
+        tile = self._loaded.get(key)
+        if tile is not None:
+            return tile
+        if key in self._deleted or key not in self._source.keys():
+            raise KeyError(key)
+        tile = self._loaded[key] = self._source.read_tile(key)
+        return tile
+
+    def __setitem__(self, key: tuple[int, int], tile: np.ndarray) -> None:
+        self._loaded[key] = tile
+        self._deleted.discard(key)
+
+    def __delitem__(self, key: tuple[int, int]) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._loaded.pop(key, None)
+        if key in self._source.keys():
+            self._deleted.add(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._loaded or (key in self._source.keys() and key not in self._deleted)
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        yield from self._loaded
+        for key in self._source.keys():
+            if key not in self._loaded and key not in self._deleted:
+                yield key
+
+    def __len__(self) -> int:
+        return len(self._loaded) + len(self._source.keys() - self._loaded.keys() - self._deleted)
+
+    @property
+    def loaded(self) -> int:
+        return len(self._loaded)
+
+
+def save_global_map(path: str, global_mapper: mapper.GlobalMapper, resolution: int) -> MapHeader:
+    origin = mapper.Pose(
+        global_mapper.observer_pos.x, global_mapper.observer_pos.y, global_mapper.heading
+    )
+    return save_map(path, global_mapper.occupancy_grid, resolution, origin)
+
+
+def load_global_map(
+    path: str, scan_matcher=None, track_distance: bool = False
+) -> tuple[mapper.GlobalMapper, MapFile]:
+    # Resumes mapping from a saved map, with the observer where it was left. The MapFile has
+    # to stay open while the mapper is in use. Distances are only computed around the cells
+    # looked up, but they're kept in memory, so tracking them is off by default.
+    map_file = MapFile(path)
+    global_mapper = mapper.GlobalMapper(
+        scan_matcher=scan_matcher, track_distance=track_distance, grid=map_file.to_tiled_map()
+    )
+    origin = map_file.header.origin
+    global_mapper.update_observer_pos(mapper.Point(origin.x, origin.y))
+    global_mapper.heading = origin.theta
+    return global_mapper, map_file
+
+
+def _pack_header(header: MapHeader) -> bytes:
+    x0, y0, width, height = header.bounds
+    return MAP_HEADER.pack(
+        MAGIC,
+        header.version,
+        header.tile_size,
+        header.resolution,
+        header.fill,
+        x0,
+        y0,
+        width,
+        height,
+        header.origin.x,
+        header.origin.y,
+        header.origin.theta,
+        header.tile_count,
+    )
+
+
+def _unpack_header(buffer) -> MapHeader:
+    if len(buffer) < MAP_HEADER.size:
+        raise ValueError("Not a map file, it's too short.")
+    (
+        magic,
+        version,
+        tile_size,
+        resolution,
+        fill,
+        x0,
+        y0,
+        width,
+        height,
+        origin_x,
+        origin_y,
+        heading,
+        tile_count,
+    ) = MAP_HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("Not a map file.")
+    if version != VERSION:
+        raise ValueError(f"Unsupported map file version {version}.")
+    if MAP_HEADER.size + tile_count * INDEX_DTYPE.itemsize > len(buffer):
+        raise ValueError("Map file is truncated.")
+    return MapHeader(
+        version,
+        tile_size,
+        resolution,
+        fill,
+        (x0, y0, width, height),
+        mapper.Pose(origin_x, origin_y, heading),
+        tile_count,
+    )
@@ -1,12 +1,13 @@
-from collections import deque
-from operator import attrgetter
+import bisect
 from mapper import bresenham
+from mapper import raycast
 from lidar import g2
 from typing import List
-from typing import Final
+from typing import Final, MutableMapping, Optional, Tuple, Union
 from dataclasses import dataclass
-from measurement import timer
+from measurement import profiler
 import math
+import numpy as np
 
 
 @dataclass
@@ -19,17 +20,26 @@ class Point:
         yield self.y
 
 
+@dataclass
+class Pose:
+    x: int
+    y: int
+    # Radians, counter-clockwise from the grid's x axis.
+    theta: float
+
+
 @dataclass
 class Map:
     dimension: tuple[int, int]
-    content: list[list[int]]
+    content: np.ndarray
 
     def __init__(self, dimension: tuple[int, int]) -> None:
         self.dimension = dimension
         x_width, y_width = dimension
 
-        # By doing this way, one should access grid like grid[y][x].
-        self.content = [[UNCERTAIN for _ in range(x_width)] for _ in range(y_width)]
+        # By doing this way, one should access grid like grid[y][x], or grid[y, x].
+        # One byte per cell, stored contiguously row by row.
+        self.content = np.full((y_width, x_width), UNCERTAIN, dtype=np.uint8)
 
     def get_center_point(self) -> tuple[int, int]:
         if self.dimension is None:
@@ -53,103 +63,135 @@ OCCUPIED: Final[int] = 255
 UNCERTAIN: Final[int] = 128
 FREE: Final[int] = 0
 
+# Free space engine constants.
+FLOOD_FILL: Final[str] = "flood"
+SCANLINE_FILL: Final[str] = "scanline"
+# Carves free space beam by beam, from cached per-resolution ray tables.
+RAYCAST: Final[str] = "raycast"
+
+# Side length of a TiledMap tile, in cells.
+TILE_SIZE: Final[int] = 64
+
+# Distances past this many cells from an obstacle all read as this.
+MAX_DISTANCE: Final[int] = 16
+
+
+class EmptyScanError(ValueError):
+    # A scan without a single valid return, there is nothing to map from it.
+    pass
+
 
 class Submapper:
     resolution: int
+    fill: str
 
-    def __init__(self, resolution) -> None:
+    def __init__(self, resolution, fill=SCANLINE_FILL) -> None:
         if resolution < 1:
             raise ValueError("Resolution cannot be less than 1.")
+        if fill not in (FLOOD_FILL, SCANLINE_FILL, RAYCAST):
+            raise ValueError(f"Unknown fill engine {fill}.")
         self.resolution = resolution
+        self.fill = fill
 
-    @timer.measure_time_in_ns
-    def lidar_to_submap(self, points: List[g2.LaserScanPoint]) -> Map:
-        rasterized = self._rasterize_points(points)
+    @profiler.profile()
+    def lidar_to_submap(self, scan: Union[g2.LaserScan, List[g2.LaserScanPoint]]) -> Map:
+        if not isinstance(scan, g2.LaserScan):
+            scan = g2.LaserScan.from_points(scan)
+        # Zero or out of range returns would only drag the outline towards the center.
+        scan = scan.gate()
+        if len(scan) == 0:
+            raise EmptyScanError("Scan has no valid returns.")
+
+        if self.fill == RAYCAST:
+            return self._raycast_submap(scan)
+
+        rasterized = self._rasterize_points(scan)
         submap = self._setup_submap(rasterized)
         adjusted = self._adjust_points(submap, rasterized)
 
         center = submap.get_center_point()
         self._draw_outer_lines(submap, adjusted)
-        self._flood_fill(submap, Point(center[0], center[1]))
+        if self.fill == SCANLINE_FILL:
+            self._scanline_fill(submap, Point(center[0], center[1]))
+        else:
+            self._flood_fill(submap, Point(center[0], center[1]))
         self._emphasize_walls(submap, adjusted)
 
         return submap
 
-    def _setup_submap(self, points: List[Point]) -> Map:
-        # https://stackoverflow.com/a/6085482
-        # An adaptive approach to scale occupancy grid.
-        # We add some immediates behind to 'pad' the map.
-        min_x = min(points, key=attrgetter("x")).x - 1
-        min_y = min(points, key=attrgetter("y")).y - 1
-        max_x = max(points, key=attrgetter("x")).x + 1
-        max_y = max(points, key=attrgetter("y")).y + 1
-
-        x_width = max_x - min_x
-        y_width = max_y - min_y
-
-        return Map((x_width, y_width))
-
-    def _adjust_points(self, map: Map, points: List[Point]) -> List[Point]:
-        x_center, y_center = map.get_center_point()
-
-        adjusted = []
-        for p in points:
-            a_x = self._clamp(p.x + x_center, 0, x_center * 2 - 1)
-            a_y = self._clamp(p.y + y_center, 0, y_center * 2 - 1)
-            adjusted.append(Point(a_x, a_y))
-
-        return adjusted
+    @profiler.profile()
+    def _raycast_submap(self, scan: g2.LaserScan) -> Map:
+        table = raycast.ray_table(self.resolution)
+        free, ends, hit = table.cast(scan.radians, scan.distances)
 
-    @timer.measure_time_in_ns
-    def _rasterize_points(self, points: List[g2.LaserScanPoint]) -> list[Point]:
-        clamped: list[Point] = []
-        for point in points:
-            # This requires towards-zero rounding, as using ceil() and floor() might slightly offset results.
-            # As rasterized points can be negative, we need to add bias to make sure
-            # coordinates are greater or equal to 0.
-            x: int = int(point.distance * math.cos(point.radian)) // self.resolution
-            y: int = int(point.distance * math.sin(point.radian)) // self.resolution
-            p = Point(x, y)
+        # The observer sits right at the center, with every beam fitting around it.
+        reach = np.abs(np.concatenate([ends, [[0, 0]]])).max(axis=0) + 1
+        submap = Map((int(reach[0]) * 2 + 1, int(reach[1]) * 2 + 1))
+        free, hits = free + reach, ends[hit] + reach
 
-            clamped.append(p)
+        submap.content[free[:, 1], free[:, 0]] = FREE
+        # Thicken the walls to 2px to make it more visible, like _emphasize_walls.
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            submap.content[hits[:, 1] + dy, hits[:, 0] + dx] = OCCUPIED
 
-        return clamped
+        return submap
 
-    @timer.measure_time_in_ns
-    def _draw_outer_lines(self, map: Map, adjusted: list[Point]):
-        points = deque()
+    # From here on, points travel as a pair of (xs, ys) integer arrays.
+    def _setup_submap(self, points: Tuple[np.ndarray, np.ndarray]) -> Map:
+        # https://stackoverflow.com/a/6085482
+        # An adaptive approach to scale occupancy grid, with the observer right at the center
+        # like _raycast_submap, however off-center it is in the room.
+        # We add some immediates behind to 'pad' the map.
+        xs, ys = points
+        x_reach = int(np.abs(xs).max()) + 1
+        y_reach = int(np.abs(ys).max()) + 1
 
-        for p in adjusted:
-            if not map.is_center_point(p):
-                points.append(p)
+        return Map((x_reach * 2 + 1, y_reach * 2 + 1))
 
-            # When it's possible to draw a outer line, do it.
-            if len(points) == 2:
-                self._draw_line(map, points[0], points[1])
-                points.popleft()
+    def _adjust_points(
+        self, map: Map, points: Tuple[np.ndarray, np.ndarray]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # The submap fits every point around its center, so nothing needs clamping.
+        x_center, y_center = map.get_center_point()
+        xs, ys = points
+        return xs + x_center, ys + y_center
+
+    @profiler.profile()
+    def _rasterize_points(self, scan: g2.LaserScan) -> Tuple[np.ndarray, np.ndarray]:
+        # This requires towards-zero rounding, as using ceil() and floor() might slightly offset results.
+        # As rasterized points can be negative, we need to add bias to make sure
+        # coordinates are greater or equal to 0.
+        xs, ys = scan.to_cartesian()
+        xs = np.trunc(xs).astype(np.int64) // self.resolution
+        ys = np.trunc(ys).astype(np.int64) // self.resolution
+        return xs, ys
+
+    @profiler.profile()
+    def _draw_outer_lines(self, map: Map, adjusted: Tuple[np.ndarray, np.ndarray]):
+        # Connect every consecutive pair of points, skipping the ones at the center.
+        xs, ys = adjusted
+        x_center, y_center = map.get_center_point()
+        on_outline = (xs != x_center) | (ys != y_center)
+        if not on_outline.any():
+            raise IndexError("Every point of the scan is at the center.")
+        outline_xs, outline_ys = xs[on_outline], ys[on_outline]
 
         # Final touch, as this segment is disconnected at first.
-        self._draw_line(map, points[0], adjusted[0])
+        end_xs = np.append(outline_xs[1:], xs[0])
+        end_ys = np.append(outline_ys[1:], ys[0])
+
+        line_xs, line_ys, _ = bresenham.bresenham_batch(outline_xs, end_xs, outline_ys, end_ys)
+        map.content[line_ys, line_xs] = FREE
 
-    def _emphasize_walls(self, map: Map, adjusted: list[Point]):
+    def _emphasize_walls(self, map: Map, adjusted: Tuple[np.ndarray, np.ndarray]):
         # Thicken the walls to 2px to make it more visible.
         x_width, y_width = map.dimension
-        for point in adjusted:
-            map.content[point.y][point.x] = OCCUPIED
-
-            if point.y + 1 < y_width:
-                map.content[point.y + 1][point.x] = OCCUPIED
-            if point.x + 1 < x_width:
-                map.content[point.y][point.x + 1] = OCCUPIED
-            if point.y + 1 < y_width and point.x + 1 < x_width:
-                map.content[point.y + 1][point.x + 1] = OCCUPIED
-
-    def _draw_line(self, map: Map, p1: Point, p2: Point):
-        line = bresenham.bresenham(p1.x, p2.x, p1.y, p2.y)
-        for l in line:
-            map.content[l[1]][l[0]] = FREE
-
-    @timer.measure_time_in_ns
+        xs, ys = adjusted
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            inside = (xs + dx < x_width) & (ys + dy < y_width)
+            map.content[ys[inside] + dy, xs[inside] + dx] = OCCUPIED
+
+    @profiler.profile()
     def _flood_fill(self, map: Map, start: Point):
         queue: list[Point] = []
         queue.append(start)
@@ -163,101 +205,415 @@ class Submapper:
             self._fill_up_free_cells(map, queue, Point(current.x + 1, current.y))
             self._fill_up_free_cells(map, queue, Point(current.x - 1, current.y))
 
+    @profiler.profile()
+    def _scanline_fill(self, map: Map, start: Point):
+        # Fills the same 4-connected region as _flood_fill, a horizontal span at a time.
+        # The outline may be open or pinch off pockets, so an even-odd polygon fill wouldn't
+        # match it cell for cell; connectivity is tracked between spans instead.
+        x_width, y_width = map.dimension
+        uncertain = map.content == UNCERTAIN
+
+        # Spans of UNCERTAIN cells, row by row and left to right. Ends are exclusive.
+        padded = np.zeros((y_width, x_width + 2), dtype=np.int8)
+        padded[:, 1:-1] = uncertain
+        edges = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        ends = np.nonzero(edges == -1)[1]
+        row_first = np.searchsorted(rows, np.arange(y_width + 1)).tolist()
+        starts_list, ends_list = starts.tolist(), ends.tolist()
+
+        def span_at(x: int, y: int) -> Optional[int]:
+            if not (0 <= x < x_width and 0 <= y < y_width) or not uncertain[y, x]:
+                return None
+            return bisect.bisect_right(starts_list, x, row_first[y], row_first[y + 1]) - 1
+
+        # The flood fill spreads from the neighbours of the start cell, not the start cell itself.
+        filled = np.zeros(len(starts_list), dtype=bool)
+        queue: list[int] = []
+        neighbours = (
+            (start.x, start.y + 1),
+            (start.x, start.y - 1),
+            (start.x + 1, start.y),
+            (start.x - 1, start.y),
+        )
+        for x, y in neighbours:
+            span = span_at(x, y)
+            if span is not None and not filled[span]:
+                filled[span] = True
+                queue.append(span)
+
+        while len(queue) > 0:
+            span = queue.pop()
+            y, left, right = int(rows[span]), starts_list[span], ends_list[span]
+
+            # Spans above and below sharing at least a column are connected.
+            for n_y in (y - 1, y + 1):
+                if n_y < 0 or n_y >= y_width:
+                    continue
+                first = bisect.bisect_right(ends_list, left, row_first[n_y], row_first[n_y + 1])
+                last = bisect.bisect_left(starts_list, right, row_first[n_y], row_first[n_y + 1])
+                for neighbour in range(first, last):
+                    if not filled[neighbour]:
+                        filled[neighbour] = True
+                        queue.append(neighbour)
+
+        # Paint the filled spans through a per-row difference array.
+        painted = np.zeros((y_width, x_width + 1), dtype=np.int32)
+        np.add.at(painted, (rows[filled], starts[filled]), 1)
+        np.add.at(painted, (rows[filled], ends[filled]), -1)
+        map.content[np.cumsum(painted, axis=1)[:, :x_width] > 0] = FREE
+
     def _fill_up_free_cells(self, map: Map, queue: list[Point], p: Point):
         if not map.is_inside(p):
             return
 
-        state = map.content[p.y][p.x]
+        state = map.content[p.y, p.x]
         if state == UNCERTAIN:
-            map.content[p.y][p.x] = FREE
+            map.content[p.y, p.x] = FREE
             queue.append(p)
 
-    def _clamp(self, a: int, min_n: int, max_n: int) -> int:
-        return min(max(a, min_n), max_n)
+
+class TiledMap:
+    # Unbounded grid made of fixed-size square tiles, each allocated the first time it's written.
+    # Cells are addressed with signed coordinates, and tile (tx, ty) covers
+    # x in [tx * tile_size, (tx + 1) * tile_size), likewise for y. Tiles are indexed like tile[y, x].
+    tile_size: int
+    fill: int
+    tiles: MutableMapping[tuple[int, int], np.ndarray]
+
+    def __init__(
+        self,
+        tile_size: int = TILE_SIZE,
+        fill: int = UNCERTAIN,
+        dtype=np.uint8,
+        tiles: Optional[MutableMapping[tuple[int, int], np.ndarray]] = None,
+    ) -> None:
+        if tile_size < 1:
+            raise ValueError("Tile size cannot be less than 1.")
+        self.tile_size = tile_size
+        self.fill = fill
+        self.dtype = np.dtype(dtype)
+        self.tiles = {} if tiles is None else tiles
+
+    def tile_key(self, x: int, y: int) -> tuple[int, int]:
+        return (x // self.tile_size, y // self.tile_size)
+
+    def get_tile(self, key: tuple[int, int], create: bool = False) -> Optional[np.ndarray]:
+        tile = self.tiles.get(key)
+        if tile is None and create:
+            tile = np.full((self.tile_size, self.tile_size), self.fill, dtype=self.dtype)
+            self.tiles[key] = tile
+        return tile
+
+    def get(self, x: int, y: int) -> int:
+        tile = self.tiles.get(self.tile_key(x, y))
+        if tile is None:
+            return self.fill
+        return tile[y % self.tile_size, x % self.tile_size]
+
+    def set(self, x: int, y: int, value: int) -> None:
+        tile = self.get_tile(self.tile_key(x, y), create=True)
+        tile[y % self.tile_size, x % self.tile_size] = value
+
+    def get_many(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        # Batched get(), one gather per distinct tile touched.
+        xs, ys = np.asarray(xs, dtype=np.int64), np.asarray(ys, dtype=np.int64)
+        values = np.full(xs.shape, self.fill, dtype=self.dtype)
+
+        keys = np.stack([xs // self.tile_size, ys // self.tile_size], axis=-1).reshape(-1, 2)
+        unique_keys, which = np.unique(keys, axis=0, return_inverse=True)
+        which = which.reshape(xs.shape)
+        for i, (tx, ty) in enumerate(unique_keys.tolist()):
+            tile = self.tiles.get((tx, ty))
+            if tile is None:
+                continue
+            selected = which == i
+            values[selected] = tile[ys[selected] % self.tile_size, xs[selected] % self.tile_size]
+        return values
+
+    def bounds(self) -> Optional[tuple[int, int, int, int]]:
+        # (x0, y0, x1, y1) covering every allocated tile, exclusive on the far side.
+        if len(self.tiles) == 0:
+            return None
+
+        keys = list(self.tiles.keys())
+        x0 = min(k[0] for k in keys) * self.tile_size
+        y0 = min(k[1] for k in keys) * self.tile_size
+        x1 = (max(k[0] for k in keys) + 1) * self.tile_size
+        y1 = (max(k[1] for k in keys) + 1) * self.tile_size
+        return (x0, y0, x1, y1)
+
+    def read_region(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        # Dense copy of [x0, x1) x [y0, y1). Cells of unallocated tiles read as `fill`.
+        region = np.full((max(y1 - y0, 0), max(x1 - x0, 0)), self.fill, dtype=self.dtype)
+        for key, (tile_window, region_window) in self._overlaps(x0, y0, x1, y1):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                region[region_window] = tile[tile_window]
+        return region
+
+    def write_region(
+        self, x0: int, y0: int, values: np.ndarray, mask: Optional[np.ndarray] = None
+    ) -> None:
+        # Writes `values` with its top-left corner at (x0, y0). With a mask, only cells where it's
+        # True are written, and tiles it doesn't touch are left unallocated.
+        y_height, x_width = values.shape
+        for key, (tile_window, region_window) in self._overlaps(
+            x0, y0, x0 + x_width, y0 + y_height
+        ):
+            if mask is None:
+                self.get_tile(key, create=True)[tile_window] = values[region_window]
+                continue
+
+            selected = mask[region_window]
+            if not selected.any():
+                continue
+            target = self.get_tile(key, create=True)[tile_window]
+            target[selected] = values[region_window][selected]
+
+    def to_map(self, region: Optional[tuple[int, int, int, int]] = None) -> Map:
+        # Dense Map of `region`, or of every allocated tile when omitted.
+        if region is None:
+            region = self.bounds() or (0, 0, 0, 0)
+        x0, y0, x1, y1 = region
+
+        dense = Map((x1 - x0, y1 - y0))
+        dense.content = self.read_region(x0, y0, x1, y1)
+        return dense
+
+    def _overlaps(self, x0: int, y0: int, x1: int, y1: int):
+        # Yields every tile key intersecting [x0, x1) x [y0, y1), along with the matching
+        # (tile slice, region slice) pair.
+        size = self.tile_size
+        for ty in range(y0 // size, (y1 - 1) // size + 1):
+            top, bottom = max(y0, ty * size), min(y1, (ty + 1) * size)
+            for tx in range(x0 // size, (x1 - 1) // size + 1):
+                left, right = max(x0, tx * size), min(x1, (tx + 1) * size)
+                tile_window = (
+                    slice(top - ty * size, bottom - ty * size),
+                    slice(left - tx * size, right - tx * size),
+                )
+                region_window = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+                yield (tx, ty), (tile_window, region_window)
+
+
+class DistanceField:
+    # Distance in cells from every cell of an occupancy grid to its nearest OCCUPIED cell,
+    # truncated at max_distance. It's kept as tiles of its own and only recomputed around
+    # the cells that changed, so lookups stay O(1) however large the grid gets.
+    # Like TiledMap, the tiles can be kept elsewhere, a float32 DiskTileStore for instance.
+    grid: TiledMap
+    max_distance: int
+
+    def __init__(
+        self,
+        grid: TiledMap,
+        max_distance: int = MAX_DISTANCE,
+        tiles: Optional[MutableMapping[tuple[int, int], np.ndarray]] = None,
+    ) -> None:
+        self.grid = grid
+        self.max_distance = max_distance
+        self._field = TiledMap(grid.tile_size, fill=max_distance, dtype=np.float32, tiles=tiles)
+        # Keys of the tiles whose distances are still to be computed from cells already in the
+        # grid, see seed().
+        self._unseeded: set[tuple[int, int]] = set()
+
+    def seed(self) -> None:
+        # The grid was filled without going through update(), when resuming from a saved map for
+        # instance. Rather than reading every tile now, distances are computed a tile at a time,
+        # the first time they're looked up. Only the keys of the grid are visited here.
+        margin = -(-self.max_distance // self.grid.tile_size)
+        for tx, ty in list(self.grid.tiles.keys()):
+            for dy in range(-margin, margin + 1):
+                for dx in range(-margin, margin + 1):
+                    self._unseeded.add((tx + dx, ty + dy))
+
+    def distance(self, x: int, y: int) -> float:
+        self._seed_around(np.array([x]), np.array([y]))
+        return float(self._field.get(x, y))
+
+    def distances(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        self._seed_around(xs, ys)
+        return self._field.get_many(xs, ys)
+
+    def _seed_around(self, xs: np.ndarray, ys: np.ndarray) -> None:
+        if not self._unseeded:
+            return
+        size = self.grid.tile_size
+        xs, ys = np.asarray(xs, dtype=np.int64), np.asarray(ys, dtype=np.int64)
+        keys = np.unique(np.stack([xs // size, ys // size], axis=-1).reshape(-1, 2), axis=0)
+        for tx, ty in keys.tolist():
+            if (tx, ty) in self._unseeded:
+                self.update(tx * size, ty * size, (tx + 1) * size, (ty + 1) * size)
+                self._unseeded.discard((tx, ty))
+
+    @profiler.profile()
+    def update(self, x0: int, y0: int, x1: int, y1: int) -> None:
+        # Occupancy changed somewhere in [x0, x1) x [y0, y1). Cells within max_distance of it
+        # may have new distances, which depend on obstacles up to max_distance further out.
+        reach = self.max_distance
+        rx0, ry0, rx1, ry1 = x0 - reach, y0 - reach, x1 + reach, y1 + reach
+        occupied = self.grid.read_region(rx0 - reach, ry0 - reach, rx1 + reach, ry1 + reach)
+        occupied = occupied == OCCUPIED
+
+        computed = self._distance_transform(occupied)[reach:-reach, reach:-reach]
+        # Only write what changed, so tiles far from any obstacle stay unallocated.
+        current = self._field.read_region(rx0, ry0, rx1, ry1)
+        self._field.write_region(rx0, ry0, computed, computed != current)
+
+    def _distance_transform(self, occupied: np.ndarray) -> np.ndarray:
+        # Exact Euclidean distances, truncated at max_distance.
+        # First the distance to the nearest obstacle within each column, then the nearest over
+        # columns dx apart as sqrt(dx^2 + column distance^2), one shifted minimum per dx.
+        y_height, x_width = occupied.shape
+        limit = self.max_distance + 1
+        rows = np.arange(y_height, dtype=np.float32)[:, None]
+
+        above = np.where(occupied, rows, -np.inf)
+        above = np.maximum.accumulate(above, axis=0)
+        below = np.where(occupied, rows, np.inf)
+        below = np.minimum.accumulate(below[::-1], axis=0)[::-1]
+        column = np.minimum(np.minimum(rows - above, below - rows), limit)
+        column_squared = column * column
+
+        squared = column_squared.copy()
+        for dx in range(1, limit):
+            shifted = column_squared[:, dx:] + dx * dx
+            np.minimum(squared[:, :-dx], shifted, out=squared[:, :-dx])
+            np.minimum(squared[:, dx:], column_squared[:, :-dx] + dx * dx, out=squared[:, dx:])
+
+        return np.minimum(np.sqrt(squared), self.max_distance).astype(np.float32)
 
 
 class GlobalMapper:
-    _occupancy_grid: Map
+    _occupancy_grid: TiledMap
     observer_pos: Point
-
-    def __init__(self, initial_dimension: tuple[int, int]) -> None:
-        self._occupancy_grid = Map(initial_dimension)
-        # We set observer's position to (0, 0), the center of the grid.
+    heading: float
+
+    def __init__(
+        self,
+        initial_dimension: Optional[tuple[int, int]] = None,
+        scan_matcher=None,
+        track_distance: bool = True,
+        grid: Optional[TiledMap] = None,
+        distance_tiles: Optional[MutableMapping[tuple[int, int], np.ndarray]] = None,
+    ) -> None:
+        # The grid grows tile by tile as the observer moves, so the initial dimension only
+        # pre-allocates the area around the origin. A grid given here is mapped on further.
+        # An out-of-core grid needs out-of-core distance_tiles as well, or the distance field
+        # grows in memory alongside it.
+        self._occupancy_grid = TiledMap() if grid is None else grid
+        if initial_dimension is not None:
+            x_width, y_height = initial_dimension
+            x0, y0 = -(x_width // 2), -(y_height // 2)
+            self._occupancy_grid.write_region(
+                x0, y0, np.full((y_height, x_width), UNCERTAIN, dtype=np.uint8)
+            )
+        # We set observer's position to (0, 0), the origin of the grid.
         self.observer_pos = Point(0, 0)
-
-    def update(self, submap: Map) -> None:
-        self._resize_on_demand(submap)
+        # Radians, counter-clockwise from the grid's x axis.
+        self.heading = 0.0
+        # IMU yaw of the previous scan that had one, see LaserScan.heading.
+        self._last_scan_heading: Optional[float] = None
+
+        # With a scan matcher (see matcher.ScanMatcher), the observer pose is estimated from
+        # every scan given to update(). last_match holds the latest result, timing included.
+        self._scan_matcher = scan_matcher
+        self.last_match = None
+
+        # Region (x0, y0, x1, y1) written by the latest update(), for incremental consumers.
+        self.last_update_region: Optional[tuple[int, int, int, int]] = None
+
+        # Distance to the nearest obstacle, kept up to date by every update().
+        self.distance_field = (
+            DistanceField(self._occupancy_grid, tiles=distance_tiles) if track_distance else None
+        )
+        if self.distance_field is not None and grid is not None:
+            self.distance_field.seed()
+
+    @profiler.profile()
+    def update(self, submap: Map, scan: Optional[g2.LaserScan] = None) -> None:
+        if scan is not None and scan.heading is not None:
+            self._follow_heading(scan.heading)
+        if scan is not None and self._scan_matcher is not None:
+            self._estimate_pose(scan)
+        if self.heading != 0:
+            submap = self._rotate_submap(submap, self.heading)
         self._update_occupancy_grid(submap)
 
     def update_observer_pos(self, new_pos: Point) -> None:
-        x_width, y_height = self._occupancy_grid.dimension
-        if (
-            new_pos.x < -(x_width // 2) + 1
-            or new_pos.x > (x_width // 2) - 1
-            or new_pos.y < -(y_height // 2) + 1
-            or new_pos.y > (y_height // 2) + 1
-        ):
-            return
-
         self.observer_pos = new_pos
 
-    def _resize_on_demand(self, submap: Map) -> None:
-        x_width, y_height = submap.dimension
-        grid_x_width, grid_y_height = self._occupancy_grid.dimension
-        x, y = self.observer_pos
-
-        # Check if the resizing is required:
-        new_grid_x_width, new_grid_y_height = grid_x_width, grid_y_height
-        offset = (0, 0)
-        if (x + grid_x_width // 2 + 1) - x_width // 2 < 0:
-            new_grid_x_width = x_width + abs(x) + 2
-            offset = (offset[0] + (new_grid_x_width - grid_x_width) // 2, offset[1])
-        if (x + grid_x_width // 2 - 1) + x_width // 2 > grid_x_width:
-            new_grid_x_width = x_width + abs(x) + 2
-            offset = (offset[0] - (new_grid_x_width - grid_x_width) // 2, offset[1])
-
-        if (y + grid_y_height // 2 - 1) - y_height // 2 < 0:
-            new_grid_y_height = grid_y_height + y_height + abs(y) + 2
-            offset = (
-                offset[0],
-                offset[1] + (new_grid_y_height - grid_y_height) // 2,
-            )
-        if (y + grid_y_height // 2 + 1) + y_height // 2 > grid_y_height:
-            new_grid_y_height = grid_y_height + y_height + abs(y) + 2
-            offset = (
-                offset[0],
-                offset[1] - (new_grid_y_height - grid_y_height) // 2,
-            )
+    @property
+    def occupancy_grid(self) -> TiledMap:
+        return self._occupancy_grid
 
-        print(grid_x_width, grid_y_height, new_grid_x_width, new_grid_y_height)
+    def get_occupancy_grid(self, region: Optional[tuple[int, int, int, int]] = None) -> Map:
+        # Dense copy of the grid for export and visualization. See TiledMap.to_map().
+        return self._occupancy_grid.to_map(region)
 
-        if new_grid_x_width != grid_x_width or new_grid_y_height != grid_y_height:
-            self._resize_grid((new_grid_x_width, new_grid_y_height), offset)
-            # Update the observer position accordingly
-            self.observer_pos = Point(x + offset[0], y + offset[1])
+    def _update_occupancy_grid(self, submap: Map) -> None:
+        x_width, y_height = submap.dimension
 
-    def _resize_grid(self, new_dim: tuple[int, int], offset: tuple[int, int]) -> None:
-        new_grid = Map(new_dim)
-        new_x_width, new_y_height = new_grid.dimension
-        x_width, y_height = self._occupancy_grid.dimension
+        # Where the submap's top-left corner lands in the grid.
+        g_x = self.observer_pos.x - x_width // 2
+        g_y = self.observer_pos.y - y_height // 2
 
-        for y in range(y_height):
-            for x in range(x_width):
-                new_x = x + new_x_width // 2 + offset[0] - 2
-                new_y = y + new_y_height // 2 + offset[1] - 2
-                new_grid.content[new_y][new_x] = self._occupancy_grid.content[y][x]
+        # Only update the obstacle / free space.
+        known = (submap.content == FREE) | (submap.content == OCCUPIED)
+        self.last_update_region = (g_x, g_y, g_x + x_width, g_y + y_height)
+        if self.distance_field is None:
+            self._occupancy_grid.write_region(g_x, g_y, submap.content, known)
+            return
 
-        self._occupancy_grid = new_grid
+        before = self._occupancy_grid.read_region(g_x, g_y, g_x + x_width, g_y + y_height)
+        self._occupancy_grid.write_region(g_x, g_y, submap.content, known)
+
+        # Obstacles appearing or disappearing are what moves distances.
+        after = np.where(known, submap.content, before)
+        changed_ys, changed_xs = np.nonzero((before == OCCUPIED) != (after == OCCUPIED))
+        if len(changed_xs) > 0:
+            self.distance_field.update(
+                g_x + int(changed_xs.min()),
+                g_y + int(changed_ys.min()),
+                g_x + int(changed_xs.max()) + 1,
+                g_y + int(changed_ys.max()) + 1,
+            )
 
-    def _update_occupancy_grid(self, submap: Map) -> None:
-        x_width, y_height = submap.dimension
-        grid_x_width, grid_y_height = self._occupancy_grid.dimension
+    def _follow_heading(self, heading: float) -> None:
+        # The IMU yaw starts anywhere and drifts, so only its change since the previous scan is
+        # applied. A scan matcher then refines the heading from there.
+        if self._last_scan_heading is not None:
+            self.heading += heading - self._last_scan_heading
+        self._last_scan_heading = heading
+
+    @profiler.profile()
+    def _estimate_pose(self, scan: g2.LaserScan) -> None:
+        # Nothing to match against before the first submap is in.
+        if len(self._occupancy_grid.tiles) == 0:
+            return
 
-        for y in range(y_height):
-            for x in range(x_width):
-                g_y = grid_y_height // 2 + self.observer_pos.y + (y - y_height // 2)
-                g_x = grid_x_width // 2 + self.observer_pos.x + (x - x_width // 2)
+        initial = Pose(self.observer_pos.x, self.observer_pos.y, self.heading)
+        self.last_match = self._scan_matcher.match(self._occupancy_grid, scan, initial)
+        if self.last_match is not None:
+            pose = self.last_match.pose
+            self.observer_pos = Point(pose.x, pose.y)
+            self.heading = pose.theta
 
-                # Only update the obstacle / free space.
-                if submap.content[y][x] == FREE or submap.content[y][x] == OCCUPIED:
-                    self._occupancy_grid.content[g_y][g_x] = submap.content[y][x]
+    def _rotate_submap(self, submap: Map, theta: float) -> Map:
+        # Rotates the submap around its center, sampling the nearest source cell of every target cell.
+        x_width, y_height = submap.dimension
+        x_center, y_center = submap.get_center_point()
+        cos, sin = math.cos(theta), math.sin(theta)
+
+        # Half extents of the rotated submap, so that its center stays the observer.
+        x_half = int(math.ceil(abs(x_center * cos) + abs(y_center * sin))) + 1
+        y_half = int(math.ceil(abs(x_center * sin) + abs(y_center * cos))) + 1
+        rotated = Map((x_half * 2 + 1, y_half * 2 + 1))
+
+        us, vs = np.meshgrid(np.arange(-x_half, x_half + 1), np.arange(-y_half, y_half + 1))
+        src_xs = np.rint(us * cos + vs * sin).astype(np.int64) + x_center
+        src_ys = np.rint(-us * sin + vs * cos).astype(np.int64) + y_center
+        inside = (src_xs >= 0) & (src_xs < x_width) & (src_ys >= 0) & (src_ys < y_height)
+        rotated.content[inside] = submap.content[src_ys[inside], src_xs[inside]]
+        return rotated
@@ -0,0 +1,184 @@
+# Correlative scan-to-map matching, after
+# Hess et al., "Real-Time Loop Closure in 2D LIDAR SLAM" (2016), section V.
+from dataclasses import dataclass
+from lidar import g2
+from mapper import mapper
+from typing import Final, List, Optional, Tuple
+
+import math
+import numpy as np
+import time
+
+# Search window constants.
+LINEAR_WINDOW: Final[int] = 16  # in cells, each way.
+ANGULAR_WINDOW: Final[float] = math.radians(20)  # each way.
+# Levels of the max-pooled grid pyramid. Level h covers 2^h x 2^h cells per lookup.
+PYRAMID_DEPTH: Final[int] = 4
+# Matches scoring below this are rejected.
+MIN_SCORE: Final[float] = 0.4
+# Scans are thinned down to about this many points before matching.
+MAX_POINTS: Final[int] = 200
+
+
+@dataclass
+class MatchResult:
+    pose: mapper.Pose
+    score: float
+    elapsed_ns: int
+
+
+class ScanMatcher:
+    # Searches (x, y, theta) around an initial pose for where a scan best lines up with
+    # the OCCUPIED cells of the grid. Every rotation is scored on a coarse max-pooled grid first,
+    # and finer levels are only visited while they can still beat the best match so far.
+    resolution: int
+    linear_window: int
+    angular_window: float
+    depth: int
+    min_score: float
+
+    def __init__(
+        self,
+        resolution: int,
+        linear_window: int = LINEAR_WINDOW,
+        angular_window: float = ANGULAR_WINDOW,
+        depth: int = PYRAMID_DEPTH,
+        min_score: float = MIN_SCORE,
+    ) -> None:
+        if resolution < 1:
+            raise ValueError("Resolution cannot be less than 1.")
+        self.resolution = resolution
+        self.linear_window = linear_window
+        self.angular_window = angular_window
+        self.depth = depth
+        self.min_score = min_score
+
+    def match(
+        self, grid: mapper.TiledMap, scan: g2.LaserScan, initial: mapper.Pose
+    ) -> Optional[MatchResult]:
+        start = time.perf_counter_ns()
+
+        points = self._scan_points(scan)
+        if len(points) == 0:
+            return None
+
+        # Everything a candidate can touch, plus room for the coarsest lookups. Rotated points
+        # reach as far as the farthest one, whichever the axis.
+        radius = np.hypot(points[:, 0], points[:, 1]).max()
+        reach = int(np.ceil(radius)) + self.linear_window + (1 << self.depth) + 1
+        x0, y0 = initial.x - reach, initial.y - reach
+        region = grid.read_region(x0, y0, initial.x + reach + 1, initial.y + reach + 1)
+        pyramid = self._build_pyramid(region)
+
+        # Every rotation of the scan at once, one row each.
+        thetas = self._rotations(points, initial.theta)
+        cos, sin = np.cos(thetas)[:, None], np.sin(thetas)[:, None]
+        xs = np.rint(points[:, 0] * cos - points[:, 1] * sin).astype(np.int64) + reach
+        ys = np.rint(points[:, 0] * sin + points[:, 1] * cos).astype(np.int64) + reach
+
+        # The coarsest candidates of all rotations are scored together and searched best first,
+        # so that a good match found early prunes most other rotations outright.
+        h = self.depth
+        offsets = np.arange(-self.linear_window, self.linear_window + 1, 1 << h)
+        dxs, dys = (a.reshape(-1) for a in np.meshgrid(offsets, offsets))
+        scores = self._score_rotations(pyramid[h], xs, ys, dxs, dys)
+
+        best_score = self.min_score
+        best: Optional[Tuple[float, int, int]] = None
+        for i in np.argsort(-scores, axis=None, kind="stable"):
+            r, c = divmod(int(i), len(dxs))
+            if scores[r, c] <= best_score:
+                break
+            found = self._branch(
+                pyramid, xs[r], ys[r], h, dxs[c : c + 1], dys[c : c + 1], (best_score, 0, 0)
+            )
+            if found[0] > best_score:
+                best_score, dx, dy = found
+                best = (thetas[r], dx, dy)
+
+        if best is None:
+            return None
+        theta, dx, dy = best
+        pose = mapper.Pose(initial.x + dx, initial.y + dy, float(theta))
+        return MatchResult(pose, best_score, time.perf_counter_ns() - start)
+
+    def _scan_points(self, scan: g2.LaserScan) -> np.ndarray:
+        # Scan points in cells, thinned to one per cell and at most MAX_POINTS.
+        scan = scan.gate().downsample_voxel(self.resolution)
+        if len(scan) > MAX_POINTS:
+            scan = scan.downsample_angular(2 * math.pi / MAX_POINTS)
+        xs, ys = scan.to_cartesian()
+        return np.stack([xs, ys], axis=1) / self.resolution
+
+    def _rotations(self, points: np.ndarray, theta: float) -> np.ndarray:
+        # Step so that the farthest point moves by about one cell between rotations.
+        farthest = max(float(np.hypot(points[:, 0], points[:, 1]).max()), 1.0)
+        step = math.acos(max(1 - 1 / (2 * farthest * farthest), -1))
+        count = int(math.ceil(self.angular_window / step))
+        return theta + np.arange(-count, count + 1) * step
+
+    def _build_pyramid(self, region: np.ndarray) -> List[np.ndarray]:
+        # Level 0 scores OCCUPIED cells 1 and their neighbours half, so near misses still count.
+        # Scores are kept as uint8 fractions of OCCUPIED, which makes max-pooling cheap.
+        occupied = np.where(region == mapper.OCCUPIED, mapper.OCCUPIED, 0).astype(np.uint8)
+        neighbours = np.pad(occupied, 1)
+        neighbours[:, 1:-1] = np.maximum.reduce(
+            [neighbours[:, :-2], neighbours[:, 1:-1], neighbours[:, 2:]]
+        )
+        neighbours[1:-1, :] = np.maximum.reduce(
+            [neighbours[:-2, :], neighbours[1:-1, :], neighbours[2:, :]]
+        )
+        level = np.maximum(occupied, neighbours[1:-1, 1:-1] // 2)
+
+        # Level h holds the max over [x, x + 2^h) x [y, y + 2^h) of level 0,
+        # padded so lookups past the far edge stay in bounds.
+        pad = 1 << self.depth
+        pyramid = [np.pad(level, ((0, pad), (0, pad)))]
+        for h in range(1, self.depth + 1):
+            below, step = pyramid[-1], 1 << (h - 1)
+            current = below.copy()
+            np.maximum(current[:-step, :], below[step:, :], out=current[:-step, :])
+            np.maximum(current[:, :-step], current[:, step:], out=current[:, :-step])
+            pyramid.append(current)
+        return pyramid
+
+    def _branch(
+        self,
+        pyramid: List[np.ndarray],
+        xs: np.ndarray,
+        ys: np.ndarray,
+        h: int,
+        dxs: np.ndarray,
+        dys: np.ndarray,
+        best: Tuple[float, int, int],
+    ) -> Tuple[float, int, int]:
+        # A level h candidate bounds every offset in [dx, dx + 2^h) x [dy, dy + 2^h) from above.
+        scores = self._score(pyramid[h], xs, ys, dxs, dys)
+
+        # Visit the most promising first, so the bound tightens early.
+        for i in np.argsort(-scores, kind="stable"):
+            if scores[i] <= best[0]:
+                break
+            if h == 0:
+                return (float(scores[i]), int(dxs[i]), int(dys[i]))
+
+            step = 1 << (h - 1)
+            child_dxs = dxs[i] + np.array([0, step, 0, step])
+            child_dys = dys[i] + np.array([0, 0, step, step])
+            inside = (child_dxs <= self.linear_window) & (child_dys <= self.linear_window)
+            best = self._branch(pyramid, xs, ys, h - 1, child_dxs[inside], child_dys[inside], best)
+        return best
+
+    def _score(
+        self, level: np.ndarray, xs: np.ndarray, ys: np.ndarray, dxs: np.ndarray, dys: np.ndarray
+    ) -> np.ndarray:
+        # Mean grid value under the scan points, for every (dx, dy) candidate at once, in [0, 1].
+        values = level[ys[None, :] + dys[:, None], xs[None, :] + dxs[:, None]]
+        return values.sum(axis=1, dtype=np.int64) / (mapper.OCCUPIED * len(xs))
+
+    def _score_rotations(
+        self, level: np.ndarray, xs: np.ndarray, ys: np.ndarray, dxs: np.ndarray, dys: np.ndarray
+    ) -> np.ndarray:
+        # _score() of every rotation, a row of xs and ys each, as a rotations x candidates array.
+        values = level[ys[:, None, :] + dys[None, :, None], xs[:, None, :] + dxs[None, :, None]]
+        return values.sum(axis=2, dtype=np.int64) / (mapper.OCCUPIED * xs.shape[1])
@@ -0,0 +1,323 @@
+from concurrent import futures
+from collections import deque
+from lidar import g2
+from mapper import mapper
+from measurement import profiler
+from typing import Callable, Dict, Final, Iterable, Optional
+
+import multiprocessing
+import os
+import threading
+import time
+
+# Queue policies. BLOCK makes the producer wait for room (backpressure up to the LiDAR ring),
+# DROP_OLDEST discards the oldest pending item so that consumers always work on fresh scans.
+BLOCK: Final[str] = "block"
+DROP_OLDEST: Final[str] = "drop_oldest"
+QUEUE_CAPACITY: Final[int] = 4
+# How submap workers are started, see MappingPipeline.start().
+WORKER_START_METHOD: Final[str] = "forkserver"
+
+
+class StageQueue:
+    # Bounded FIFO between two pipeline stages, recording its depth and how long items wait in it.
+    name: str
+    capacity: int
+    policy: str
+    puts: int
+    dropped: int
+    max_depth: int
+
+    def __init__(
+        self, name: str, capacity: int, policy: str, metrics: profiler.Profiler
+    ) -> None:
+        if capacity < 1:
+            raise ValueError("Capacity cannot be less than 1.")
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(f"Unknown queue policy {policy}.")
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.puts = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._items = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._metrics = metrics
+
+    def put(self, item) -> bool:
+        # Returns False if the queue was closed, in which case the item is discarded.
+        with self._condition:
+            if self.policy == BLOCK:
+                self._condition.wait_for(
+                    lambda: len(self._items) < self.capacity or self._closed
+                )
+            # Pending items of a closed queue are still handed out, so none may be dropped.
+            if self._closed:
+                return False
+            if len(self._items) == self.capacity:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append((item, time.perf_counter_ns()))
+            self.puts += 1
+            self._depth_total += len(self._items)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._condition.notify_all()
+            return True
+
+    def get(self, timeout: Optional[float] = None):
+        # Returns the oldest item, or None once the queue is closed and drained.
+        with self._condition:
+            self._condition.wait_for(lambda: self._items or self._closed, timeout)
+            if not self._items:
+                if not self._closed:
+                    raise TimeoutError(f"Nothing arrived on {self.name} in time.")
+                return None
+            item, enqueued = self._items.popleft()
+            self._condition.notify_all()
+        self._metrics.record(f"queue/{self.name}/wait", time.perf_counter_ns() - enqueued)
+        return item
+
+    def close(self) -> None:
+        # Pending items are still handed out, further puts are refused.
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._items)
+
+    def summary(self) -> Dict[str, float]:
+        with self._condition:
+            return {
+                "policy": self.policy,
+                "capacity": self.capacity,
+                "depth": len(self._items),
+                "mean_depth": self._depth_total / self.puts if self.puts else 0,
+                "max_depth": self.max_depth,
+                "puts": self.puts,
+                "dropped": self.dropped,
+            }
+
+
+# Per-process state of the submap workers.
+_worker_submapper: Optional[mapper.Submapper] = None
+
+
+def _init_worker(resolution: int, fill: str) -> None:
+    global _worker_submapper
+    _worker_submapper = mapper.Submapper(resolution, fill)
+
+
+def _make_submap(scan: g2.LaserScan) -> mapper.Map:
+    return _worker_submapper.lidar_to_submap(scan)
+
+
+class MappingPipeline:
+    # Runs acquisition, submap generation and global fusion as separate stages:
+    #
+    #   scans --[scans]--> dispatch --(process pool)--> collect --[submaps]--> fuse
+    #
+    # Acquisition, dispatch, collection and fusion each own a thread. Submaps are built in a
+    # process pool since lidar_to_submap holds the GIL for most of its time. The collector waits
+    # on results in submission order, so fusion sees the scans in the order they were taken.
+    # With workers=0 submaps are built on the dispatch thread instead.
+    metrics: profiler.Profiler
+    global_mapper: mapper.GlobalMapper
+    completed: int
+    rejected: int
+
+    def __init__(
+        self,
+        scans: Iterable[g2.LaserScan],
+        global_mapper: mapper.GlobalMapper,
+        resolution: int,
+        fill: str = mapper.SCANLINE_FILL,
+        workers: Optional[int] = None,
+        queue_capacity: int = QUEUE_CAPACITY,
+        scan_policy: str = DROP_OLDEST,
+        submap_policy: str = BLOCK,
+        on_update: Optional[Callable[[mapper.GlobalMapper, g2.LaserScan], None]] = None,
+    ) -> None:
+        if workers is None:
+            # One core is left to acquisition and fusion.
+            workers = max((os.cpu_count() or 1) - 1, 1)
+        self.metrics = profiler.Profiler(enabled=True)
+        self.global_mapper = global_mapper
+        self.completed = 0
+        self.rejected = 0
+        self._scans = scans
+        self._resolution = resolution
+        self._fill = fill
+        self._workers = workers
+        self._on_update = on_update
+        self._scan_queue = StageQueue("scans", queue_capacity, scan_policy, self.metrics)
+        # Bounds the number of submaps being built, so that dispatch pushes back on the scans.
+        self._inflight = StageQueue("inflight", max(workers, 1) * 2, BLOCK, self.metrics)
+        self._submap_queue = StageQueue("submaps", queue_capacity, submap_policy, self.metrics)
+        self._map_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._threads = []
+        self._pool: Optional[futures.ProcessPoolExecutor] = None
+        self._started_at = 0.0
+        self._finished_at = 0.0
+
+    def start(self) -> None:
+        if self._threads:
+            raise RuntimeError("The pipeline was started already.")
+        if self._workers > 0:
+            # By now the LiDAR reader, the IMU sampler or the viewer may be running threads, and a
+            # forked worker could inherit a lock one of them holds and deadlock. Workers are forked
+            # from a clean server process instead, which imports the main module of the program:
+            # it has to keep what it runs under `if __name__ == "__main__"`.
+            self._pool = futures.ProcessPoolExecutor(
+                self._workers,
+                mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                initializer=_init_worker,
+                initargs=(self._resolution, self._fill),
+            )
+        else:
+            _init_worker(self._resolution, self._fill)
+        self._started_at = time.monotonic()
+        for name, target in (
+            ("acquire", self._acquire),
+            ("dispatch", self._dispatch),
+            ("collect", self._collect),
+            ("fuse", self._fuse),
+        ):
+            thread = threading.Thread(target=self._run_stage, args=(target,), name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        # Waits until every scan went through, then re-raises the first stage failure if any.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            thread.join(remaining)
+            if thread.is_alive():
+                raise TimeoutError(f"Pipeline stage {thread.name} is still running.")
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        if self._error is not None:
+            raise self._error
+
+    def run(self) -> None:
+        self.start()
+        self.join()
+
+    def stop(self) -> None:
+        # Pending scans are discarded. The scan source should be closed by the caller as well,
+        # G2.stop_stream() for instance, if it can block.
+        self._stopping.set()
+        for queue in (self._scan_queue, self._inflight, self._submap_queue):
+            queue.close()
+
+    def is_running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def occupancy_grid(self, region: Optional[tuple[int, int, int, int]] = None) -> mapper.Map:
+        # Dense copy of the global map, safe to call while fusion is running.
+        with self._map_lock:
+            return self.global_mapper.get_occupancy_grid(region)
+
+    def scans_per_second(self) -> float:
+        end = self._finished_at or time.monotonic()
+        elapsed = end - self._started_at
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {
+            f"queue/{queue.name}": queue.summary()
+            for queue in (self._scan_queue, self._inflight, self._submap_queue)
+        }
+        summary.update({name: s.summary() for name, s in self.metrics.stats().items()})
+        return summary
+
+    def to_table(self) -> str:
+        header = f"{'queue':<20} {'policy':>12} {'capacity':>8} {'mean depth':>10} {'max depth':>9} {'puts':>8} {'dropped':>8}"
+        lines = [
+            f"{self.completed} scans fused, {self.rejected} rejected, "
+            f"{self.scans_per_second():.1f} scans/s",
+            header,
+            "-" * len(header),
+        ]
+        for queue in (self._scan_queue, self._inflight, self._submap_queue):
+            s = queue.summary()
+            lines.append(
+                f"{queue.name:<20} {s['policy']:>12} {s['capacity']:>8} {s['mean_depth']:>10.2f} "
+                f"{s['max_depth']:>9} {s['puts']:>8} {s['dropped']:>8}"
+            )
+        return "\n".join(lines) + "\n\n" + self.metrics.to_table()
+
+    def _run_stage(self, target: Callable[[], None]) -> None:
+        try:
+            target()
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self.stop()
+
+    def _acquire(self) -> None:
+        try:
+            for scan in self._scans:
+                if self._stopping.is_set():
+                    break
+                # Latency is measured from the moment the scan entered the pipeline.
+                if not self._scan_queue.put((scan, time.perf_counter_ns())):
+                    break
+        finally:
+            self._scan_queue.close()
+
+    def _dispatch(self) -> None:
+        try:
+            while (item := self._scan_queue.get()) is not None:
+                scan, entered = item
+                if self._pool is not None:
+                    future = self._pool.submit(_make_submap, scan)
+                else:
+                    future = futures.Future()
+                    try:
+                        future.set_result(_make_submap(scan))
+                    except Exception as e:
+                        future.set_exception(e)
+                if not self._inflight.put((scan, entered, future, time.perf_counter_ns())):
+                    future.cancel()
+                    break
+        finally:
+            self._inflight.close()
+
+    def _collect(self) -> None:
+        try:
+            while (item := self._inflight.get()) is not None:
+                scan, entered, future, submitted = item
+                try:
+                    submap = future.result()
+                except mapper.EmptyScanError:
+                    # No valid returns in this scan, nothing to fuse.
+                    self.rejected += 1
+                    continue
+                self.metrics.record("stage/submap", time.perf_counter_ns() - submitted)
+                if not self._submap_queue.put((scan, entered, submap)):
+                    break
+        finally:
+            self._submap_queue.close()
+
+    def _fuse(self) -> None:
+        try:
+            while (item := self._submap_queue.get()) is not None:
+                scan, entered, submap = item
+                with self.metrics.span("stage/fuse"):
+                    with self._map_lock:
+                        self.global_mapper.update(submap, scan)
+                self.metrics.record("pipeline/latency", time.perf_counter_ns() - entered)
+                self.completed += 1
+                if self._on_update is not None:
+                    self._on_update(self.global_mapper, scan)
+        finally:
+            self._finished_at = time.monotonic()
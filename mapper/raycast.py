@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from lidar import g2
+from typing import Final, Tuple
+
+import math
+import numpy as np
+
+# Upper bound on the memory held by all cached tables, in bytes.
+CACHE_BUDGET: Final[int] = 64 * 1024 * 1024
+# Part of the budget kept for the intermediates of tracing rows, which is done this many bytes
+# at a time.
+TRACE_BUDGET: Final[int] = 4 * 1024 * 1024
+
+
+class RayTable:
+    # Cells crossed by a beam leaving the origin, for each quantized angle, up to g2.MAX_RANGE.
+    # The beams of a bin all advance one cell along its major axis per step, so row `bin` only
+    # holds the minor axis offset of the cell `k` steps away, rint(k * slope) at the bin center.
+    # Rows are only traced the first time a beam falls into their bin.
+    #
+    # Within a bin, a beam drifts from the row by up to k * 2 * pi / angle_bins cells after k
+    # steps. Rows are used for the first exact_steps = angle_bins / (4 * pi) steps, where every
+    # cell stays within one cell of the true beam, measured across it. Down to about 18 mm per
+    # cell, enough bins for the whole range fit the budget. Finer tables hold fewer bins, and the
+    # cells of a beam past exact_steps are computed from its own angle on every cast instead.
+    resolution: int
+    angle_bins: int
+    max_steps: int
+    exact_steps: int
+
+    def __init__(self, resolution: int, budget: int = CACHE_BUDGET) -> None:
+        self.resolution = resolution
+        self.max_steps = g2.MAX_RANGE // resolution
+
+        # As many bins as the whole range needs, or as fit the budget next to the tracing.
+        row_bytes = self.max_steps * np.dtype(np.int16).itemsize
+        needed = math.ceil(4 * math.pi * self.max_steps)
+        self.angle_bins = max(min(needed, (budget - TRACE_BUDGET) // row_bytes), 1)
+        self.exact_steps = min(int(self.angle_bins / (4 * math.pi)), self.max_steps)
+
+        # np.empty doesn't touch the pages, so untraced rows cost no memory yet.
+        self._minor = np.empty((self.angle_bins, self.max_steps), dtype=np.int16)
+        self._traced = np.zeros(self.angle_bins, dtype=bool)
+
+        radians = (np.arange(self.angle_bins) + 0.5) * (2 * math.pi / self.angle_bins)
+        self._x_major = np.abs(np.cos(radians)) >= np.abs(np.sin(radians))
+        _, self._major_sign, self._slopes = _along(radians, self._x_major)
+
+    @property
+    def nbytes(self) -> int:
+        return self._minor.nbytes
+
+    def cast(
+        self, radians: np.ndarray, distances: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Returns the free cells, the end cell of every beam, both as (N, 2) arrays of (x, y) offsets,
+        # and whether each beam ended on an obstacle.
+        # Zero distances are invalid returns, and beams at MAX_RANGE didn't hit anything.
+        radians = np.asarray(radians, dtype=np.float64)
+        distances = np.asarray(distances)
+        valid = distances > 0
+        radians, distances = radians[valid], distances[valid]
+
+        bins = (np.floor(radians / (2 * math.pi) * self.angle_bins) % self.angle_bins).astype(np.int64)
+        self._trace(bins)
+
+        # Every beam along its own angle, in the axes of its bin.
+        x_major, sign = self._x_major[bins], self._major_sign[bins]
+        major, _, slopes = _along(radians, x_major)
+        steps = np.floor(distances * major / self.resolution).astype(np.int64)
+        hit = steps < self.max_steps
+        steps = np.minimum(steps, self.max_steps)
+        ends = _to_cells(x_major, sign * steps, np.rint(steps * slopes).astype(np.int64))
+
+        # Cell `k` of every beam, for every k before its end, gathered in one go.
+        # Steps fit in an int16 and a scan in an int32, which keeps these arrays small.
+        offsets = np.zeros(len(steps) + 1, dtype=np.int32)
+        np.cumsum(steps, out=offsets[1:])
+        beam = np.repeat(np.arange(len(steps), dtype=np.int32), steps)
+        k = np.arange(offsets[-1], dtype=np.int32) - offsets[beam]
+        if self.exact_steps >= self.max_steps:
+            minor = self._minor[bins[beam], k]
+        else:
+            near = k < self.exact_steps
+            minor = np.empty(len(k), dtype=np.int16)
+            minor[near] = self._minor[bins[beam[near]], k[near]]
+            far = ~near
+            minor[far] = np.rint(k[far] * slopes[beam[far]])
+        free = _to_cells(x_major[beam], sign[beam].astype(np.int16) * k.astype(np.int16), minor)
+        return free, ends, hit
+
+    def _trace(self, bins: np.ndarray) -> None:
+        missing = np.unique(bins[~self._traced[bins]])
+        # A few rows at a time, so that the float64 intermediates stay within TRACE_BUDGET.
+        chunk = max(TRACE_BUDGET // (self.max_steps * np.dtype(np.float64).itemsize), 1)
+        k = np.arange(self.max_steps)
+        for start in range(0, len(missing), chunk):
+            rows = missing[start : start + chunk]
+            self._minor[rows] = np.rint(k * self._slopes[rows, None])
+            self._traced[rows] = True
+
+
+def _along(radians: np.ndarray, x_major: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Per direction: how far it advances along the given major axis per unit of range, the sign
+    # of that advance, and the minor axis offset per major axis step.
+    cos, sin = np.cos(radians), np.sin(radians)
+    major, minor = np.where(x_major, cos, sin), np.where(x_major, sin, cos)
+    return np.abs(major), np.where(major < 0, -1, 1), minor / np.abs(major)
+
+
+def _to_cells(x_major: np.ndarray, major: np.ndarray, minor: np.ndarray) -> np.ndarray:
+    return np.stack([np.where(x_major, major, minor), np.where(x_major, minor, major)], axis=1)
+
+
+class RayTableCache:
+    # Keeps the most recently used tables, evicting older ones once they exceed the budget.
+    budget: int
+
+    def __init__(self, budget: int = CACHE_BUDGET) -> None:
+        self.budget = budget
+        self._tables: OrderedDict[int, RayTable] = OrderedDict()
+
+    def get(self, resolution: int) -> RayTable:
+        table = self._tables.get(resolution)
+        if table is not None:
+            self._tables.move_to_end(resolution)
+            return table
+
+        table = RayTable(resolution, self.budget)
+        self._tables[resolution] = table
+        # Whatever is being traced counts towards the budget too.
+        while (
+            sum(t.nbytes for t in self._tables.values()) + TRACE_BUDGET > self.budget
+            and len(self._tables) > 1
+        ):
+            self._tables.popitem(last=False)
+        return table
+
+
+_cache = RayTableCache()
+
+
+def ray_table(resolution: int) -> RayTable:
+    return _cache.get(resolution)
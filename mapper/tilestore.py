@@ -0,0 +1,276 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from mapper import mapper
+from measurement import profiler
+from typing import Dict, Final, Iterator, Optional
+
+import numpy as np
+import os
+import queue
+import struct
+import threading
+import zlib
+
+# Store layout: `path` holds fixed-size slots of raw tile cells, `path`.index maps tile keys
+# to slots. The index is rewritten by flush(), slots are written in place.
+INDEX_MAGIC: Final[bytes] = b"DLBXTIL\x00"
+INDEX_HEADER: Final[struct.Struct] = struct.Struct("<8sH4sI")
+INDEX_DTYPE: Final[np.dtype] = np.dtype([("tx", "<i4"), ("ty", "<i4"), ("slot", "<u4")])
+# 4096 uint8 tiles of 64 x 64 cells make 16 MiB of working set.
+WORKING_SET: Final[int] = 4096
+WRITE_BACK_CAPACITY: Final[int] = 256
+
+
+class DiskTileStore(MutableMapping):
+    # Tile store of a TiledMap kept on disk, with only the `working_set` most recently used
+    # tiles in memory. Evicted tiles are written back by a background thread, and only if their
+    # cells changed since they were read. A tile looked up while waiting for write-back is
+    # taken back from the queue without touching the disk.
+    #
+    # TiledMap(tiles=DiskTileStore("site.tiles")) turns any grid into an out-of-core one.
+    path: str
+    tile_size: int
+    dtype: np.dtype
+    working_set: int
+    metrics: profiler.Profiler
+    hits: int
+    misses: int
+    reads: int
+    writes: int
+    evictions: int
+
+    def __init__(
+        self,
+        path: str,
+        tile_size: int = mapper.TILE_SIZE,
+        dtype=np.uint8,
+        working_set: int = WORKING_SET,
+        write_back_capacity: int = WRITE_BACK_CAPACITY,
+    ) -> None:
+        if working_set < 1:
+            raise ValueError("Working set cannot be less than 1 tile.")
+        self.path = path
+        self.tile_size = tile_size
+        self.dtype = np.dtype(dtype)
+        self.working_set = working_set
+        self.metrics = profiler.Profiler(enabled=True)
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+        self.writes = 0
+        self.evictions = 0
+        self._tile_bytes = tile_size * tile_size * self.dtype.itemsize
+
+        # key -> (tile, crc32 of its cells when it was last on disk, None if never)
+        self._cache: OrderedDict = OrderedDict()
+        self._slots: Dict[tuple[int, int], int] = {}
+        self._free_slots = []
+        self._slot_count = 0
+        # Evicted tiles not written yet, key -> tile.
+        self._pending: Dict[tuple[int, int], np.ndarray] = {}
+        self._lock = threading.RLock()
+
+        self._load_index()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._write_back = queue.Queue(write_back_capacity)
+        self._error: Optional[BaseException] = None
+        self._writer = threading.Thread(target=self._write_loop, name="tile-writer", daemon=True)
+        self._writer.start()
+
+    def __getitem__(self, key: tuple[int, int]) -> np.ndarray:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return entry[0]
+
+            self.misses += 1
+            tile = self._pending.get(key)
+            if tile is not None:
+                # Still queued for write-back, which may not have happened yet.
+                evicted = self._insert(key, tile, None)
+            else:
+                slot = self._slots.get(key)
+                if slot is None:
+                    raise KeyError(key)
+                tile = self._read(slot)
+                evicted = self._insert(key, tile, zlib.crc32(tile))
+        self._enqueue(evicted)
+        return tile
+
+    def __setitem__(self, key: tuple[int, int], tile: np.ndarray) -> None:
+        if tile.shape != (self.tile_size, self.tile_size) or tile.dtype != self.dtype:
+            raise ValueError(f"Tiles must be {self.tile_size} x {self.tile_size} of {self.dtype}.")
+        with self._lock:
+            self._cache.pop(key, None)
+            evicted = self._insert(key, tile, None)
+        self._enqueue(evicted)
+
+    def __delitem__(self, key: tuple[int, int]) -> None:
+        with self._lock:
+            in_cache = self._cache.pop(key, None) is not None
+            slot = self._slots.pop(key, None)
+            if slot is None and not in_cache:
+                raise KeyError(key)
+            self._pending.pop(key, None)
+            if slot is not None:
+                self._free_slots.append(slot)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._cache or key in self._slots
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        with self._lock:
+            keys = list(self._cache.keys())
+            keys.extend(key for key in self._slots if key not in self._cache)
+        return iter(keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._cache) + sum(1 for key in self._slots if key not in self._cache)
+
+    def flush(self) -> None:
+        # Writes every changed tile, cached ones included, and the index.
+        with self._lock:
+            changed = [
+                self._schedule_write(key, tile)
+                for key, (tile, crc) in self._cache.items()
+                if crc != zlib.crc32(tile)
+            ]
+        self._enqueue(changed)
+        self._write_back.join()
+        self._check_writer()
+        with self._lock:
+            for key, (tile, _) in self._cache.items():
+                self._cache[key] = (tile, zlib.crc32(tile))
+            self._save_index()
+
+    def close(self) -> None:
+        self.flush()
+        self._write_back.put(None)
+        self._writer.join()
+        os.close(self._fd)
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            summary = {
+                "tiles": len(self),
+                "cached": len(self._cache),
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "reads": self.reads,
+                "writes": self.writes,
+                "bytes_read": self.reads * self._tile_bytes,
+                "bytes_written": self.writes * self._tile_bytes,
+            }
+        summary.update({name: s.summary() for name, s in self.metrics.stats().items()})
+        return summary
+
+    def __enter__(self) -> "DiskTileStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _insert(self, key: tuple[int, int], tile: np.ndarray, crc: Optional[int]) -> list:
+        # Caller holds the lock, and hands the returned writes to _enqueue() once released.
+        self._cache[key] = (tile, crc)
+        evicted = []
+        while len(self._cache) > self.working_set:
+            old_key, (old_tile, old_crc) = self._cache.popitem(last=False)
+            self.evictions += 1
+            if old_crc != zlib.crc32(old_tile):
+                evicted.append(self._schedule_write(old_key, old_tile))
+        return evicted
+
+    def _schedule_write(self, key: tuple[int, int], tile: np.ndarray) -> tuple:
+        # Caller holds the lock. From here on lookups find the tile in _pending.
+        if key not in self._slots:
+            if self._free_slots:
+                self._slots[key] = self._free_slots.pop()
+            else:
+                self._slots[key] = self._slot_count
+                self._slot_count += 1
+        self._pending[key] = tile
+        return (key, tile, self._slots[key])
+
+    def _enqueue(self, writes: list) -> None:
+        # Blocks while the write-back queue is full, which bounds the memory held by evicted
+        # tiles. Never called with the lock held, as the writer needs it to finish a write.
+        self._check_writer()
+        for write in writes:
+            self._write_back.put(write)
+
+    def _write_loop(self) -> None:
+        while (write := self._write_back.get()) is not None:
+            key, tile, slot = write
+            try:
+                with self.metrics.span("tilestore/write"):
+                    os.pwrite(self._fd, np.ascontiguousarray(tile).tobytes(), slot * self._tile_bytes)
+                with self._lock:
+                    self.writes += 1
+                    # A newer eviction of the same key queued a write of its own.
+                    if self._pending.get(key) is tile:
+                        del self._pending[key]
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._write_back.task_done()
+        self._write_back.task_done()
+
+    def _check_writer(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _read(self, slot: int) -> np.ndarray:
+        with self.metrics.span("tilestore/read"):
+            data = os.pread(self._fd, self._tile_bytes, slot * self._tile_bytes)
+        if len(data) != self._tile_bytes:
+            raise ValueError(f"Tile slot {slot} of {self.path} is truncated.")
+        self.reads += 1
+        return np.frombuffer(bytearray(data), dtype=self.dtype).reshape(
+            self.tile_size, self.tile_size
+        )
+
+    def _index_path(self) -> str:
+        return self.path + ".index"
+
+    def _load_index(self) -> None:
+        try:
+            with open(self._index_path(), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        magic, tile_size, dtype, count = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{self._index_path()} is not a tile store index.")
+        if tile_size != self.tile_size or np.dtype(dtype.rstrip(b"\x00").decode()) != self.dtype:
+            raise ValueError(f"{self.path} holds tiles of another size or type.")
+        index = np.frombuffer(data, INDEX_DTYPE, count, INDEX_HEADER.size)
+        self._slots = {
+            (tx, ty): slot
+            for tx, ty, slot in zip(index["tx"].tolist(), index["ty"].tolist(), index["slot"].tolist())
+        }
+        self._slot_count = max(self._slots.values(), default=-1) + 1
+        used = set(self._slots.values())
+        self._free_slots = [slot for slot in range(self._slot_count) if slot not in used]
+
+    def _save_index(self) -> None:
+        index = np.zeros(len(self._slots), dtype=INDEX_DTYPE)
+        for i, ((tx, ty), slot) in enumerate(self._slots.items()):
+            index[i] = (tx, ty, slot)
+        temporary = self._index_path() + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.tile_size, self.dtype.str.encode(), len(index)))
+            f.write(index.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # Tiles first, then the index pointing at them, so that neither is ever ahead on disk.
+        os.fsync(self._fd)
+        os.replace(temporary, self._index_path())
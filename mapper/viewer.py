@@ -0,0 +1,226 @@
+from mapper import mapper
+from multiprocessing import shared_memory
+from multiprocessing import synchronize
+from typing import Final, Optional
+
+import multiprocessing
+import numpy as np
+import struct
+
+# Shared frame layout: header, one version counter per tile, then the cells row by row.
+# The header holds (x0, y0, width, height, tile_size) of the mirrored grid region.
+FRAME_HEADER: Final[struct.Struct] = struct.Struct("<iiIII")
+FRAME_ALIGNMENT: Final[int] = 8
+FRAME_REGION: Final[tuple[int, int, int, int]] = (-1024, -1024, 1024, 1024)
+VIEWER_FPS: Final[float] = 10.0
+# Largest side of the displayed image, in pixels. Bigger frames are max-pooled down to it.
+MAX_DISPLAY: Final[int] = 512
+# How the viewer process is started, see MapViewer.start().
+VIEWER_START_METHOD: Final[str] = "forkserver"
+
+
+def _align(offset: int) -> int:
+    return (offset + FRAME_ALIGNMENT - 1) // FRAME_ALIGNMENT * FRAME_ALIGNMENT
+
+
+class SharedFrame:
+    # Copy of a fixed region of the global map in shared memory, split in tiles.
+    # Writers copy a tile, then bump its version. Readers copy tiles whose version moved since
+    # they last looked, remembering the version seen *before* copying, so that a tile written
+    # meanwhile is simply copied again on the next poll. Neither side ever waits on the other.
+    x0: int
+    y0: int
+    width: int
+    height: int
+    tile_size: int
+    versions: np.ndarray
+    cells: np.ndarray
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool) -> None:
+        self.shm = shm
+        self._owner = owner
+        self.x0, self.y0, self.width, self.height, self.tile_size = FRAME_HEADER.unpack_from(shm.buf)
+        tiles_y, tiles_x = self.height // self.tile_size, self.width // self.tile_size
+        versions_offset = _align(FRAME_HEADER.size)
+        cells_offset = _align(versions_offset + tiles_y * tiles_x * 4)
+        self.versions = np.ndarray((tiles_y, tiles_x), np.uint32, shm.buf, versions_offset)
+        self.cells = np.ndarray((self.height, self.width), np.uint8, shm.buf, cells_offset)
+
+    @classmethod
+    def create(
+        cls, region: tuple[int, int, int, int] = FRAME_REGION, tile_size: int = mapper.TILE_SIZE
+    ) -> "SharedFrame":
+        # The region is widened to whole tiles.
+        x0, y0, x1, y1 = region
+        x0, y0 = x0 // tile_size * tile_size, y0 // tile_size * tile_size
+        width = -(-(x1 - x0) // tile_size) * tile_size
+        height = -(-(y1 - y0) // tile_size) * tile_size
+        tiles = (width // tile_size) * (height // tile_size)
+        size = _align(_align(FRAME_HEADER.size) + tiles * 4) + width * height
+
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        FRAME_HEADER.pack_into(shm.buf, 0, x0, y0, width, height, tile_size)
+        frame = cls(shm, owner=True)
+        frame.versions[:] = 0
+        frame.cells[:] = mapper.UNCERTAIN
+        return frame
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedFrame":
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def publish(self, global_mapper: mapper.GlobalMapper, region: Optional[tuple] = None) -> None:
+        # Mirrors `region` of the global map, by default the one its latest update wrote.
+        region = region or global_mapper.last_update_region
+        if region is None:
+            return
+        size = self.tile_size
+        # Clip to the frame, then widen to whole tiles.
+        x0 = max(region[0], self.x0) - self.x0
+        y0 = max(region[1], self.y0) - self.y0
+        x1 = min(region[2], self.x0 + self.width) - self.x0
+        y1 = min(region[3], self.y0 + self.height) - self.y0
+        if x0 >= x1 or y0 >= y1:
+            return
+        tx0, ty0 = x0 // size, y0 // size
+        tx1, ty1 = -(-x1 // size), -(-y1 // size)
+
+        content = global_mapper.get_occupancy_grid(
+            (
+                self.x0 + tx0 * size,
+                self.y0 + ty0 * size,
+                self.x0 + tx1 * size,
+                self.y0 + ty1 * size,
+            )
+        ).content
+        self.cells[ty0 * size : ty1 * size, tx0 * size : tx1 * size] = content
+        self.versions[ty0:ty1, tx0:tx1] += 1
+
+    def close(self) -> None:
+        # Drop the array views first, shared memory refuses to close while they're exported.
+        del self.versions, self.cells
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+class FrameReader:
+    # Keeps a down-sampled image of a SharedFrame, refreshing only the tiles that changed.
+    # Max-pooling keeps thin walls visible, as OCCUPIED is the largest cell value.
+    factor: int
+    display: np.ndarray
+
+    def __init__(self, frame: SharedFrame, max_display: int = MAX_DISPLAY) -> None:
+        self._frame = frame
+        # Powers of two up to the tile size, so that tiles map onto whole display blocks.
+        self.factor = 1
+        while (
+            max(frame.width, frame.height) > max_display * self.factor
+            and self.factor < frame.tile_size
+        ):
+            self.factor *= 2
+        self.display = np.full(
+            (frame.height // self.factor, frame.width // self.factor), mapper.UNCERTAIN, np.uint8
+        )
+        self._seen = np.zeros_like(frame.versions)
+
+    def poll(self) -> int:
+        # Returns how many tiles were refreshed.
+        versions = self._frame.versions.copy()
+        dirty_ys, dirty_xs = np.nonzero(versions != self._seen)
+        size, factor = self._frame.tile_size, self.factor
+        block = size // factor
+        for ty, tx in zip(dirty_ys, dirty_xs):
+            tile = self._frame.cells[ty * size : (ty + 1) * size, tx * size : (tx + 1) * size]
+            pooled = tile.reshape(block, factor, block, factor).max(axis=(1, 3))
+            self.display[ty * block : (ty + 1) * block, tx * block : (tx + 1) * block] = pooled
+        self._seen = versions
+        return len(dirty_ys)
+
+
+def _run_viewer(name: str, stop: synchronize.Event, fps: float, max_display: int) -> None:
+    import matplotlib.pyplot as plt
+
+    frame = SharedFrame.attach(name)
+    reader = FrameReader(frame, max_display)
+    reader.poll()
+
+    fig, ax = plt.subplots()
+    # Cells grow downwards in y, like the rows of the image.
+    extent = (frame.x0, frame.x0 + frame.width, frame.y0 + frame.height, frame.y0)
+    image = ax.imshow(reader.display, cmap="binary", vmin=0, vmax=255, extent=extent)
+    try:
+        while not stop.is_set() and plt.fignum_exists(fig.number):
+            if reader.poll() > 0:
+                image.set_data(reader.display)
+                fig.canvas.draw_idle()
+            plt.pause(1 / fps)
+    finally:
+        plt.close(fig)
+        del reader
+        frame.close()
+
+
+class MapViewer:
+    # Live view of the global map, drawn by a separate process at its own frame rate.
+    # publish() only copies the tiles touched by the latest update into shared memory,
+    # so the mapper never waits on drawing.
+    frame: Optional[SharedFrame]
+
+    def __init__(
+        self,
+        region: tuple[int, int, int, int] = FRAME_REGION,
+        fps: float = VIEWER_FPS,
+        max_display: int = MAX_DISPLAY,
+    ) -> None:
+        self._region = region
+        self._fps = fps
+        self._max_display = max_display
+        self._context = multiprocessing.get_context(VIEWER_START_METHOD)
+        self._stop = self._context.Event()
+        self._process: Optional[multiprocessing.process.BaseProcess] = None
+        self.frame = None
+
+    def start(self) -> None:
+        # Like the submap workers, the viewer is forked from a clean server process rather than
+        # from this one, so it can be started at any time, whatever threads are running already.
+        self.frame = SharedFrame.create(self._region)
+        self._process = self._context.Process(
+            target=_run_viewer,
+            args=(self.frame.name, self._stop, self._fps, self._max_display),
+            name="map-viewer",
+            daemon=True,
+        )
+        self._process.start()
+
+    def publish(self, global_mapper: mapper.GlobalMapper, *_) -> None:
+        # Fits MappingPipeline's on_update callback.
+        if self.frame is not None:
+            self.frame.publish(global_mapper)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        # Waits for the viewer window to be closed.
+        if self._process is not None:
+            self._process.join(timeout)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._process is not None:
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+        if self.frame is not None:
+            self.frame.close()
+            self.frame = None
+
+    def __enter__(self) -> "MapViewer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,110 @@
+from typing import Final
+
+import numpy as np
+import time
+
+# Every sensor stamps its data with now(), so that LiDAR revolutions, IMU samples and the
+# mapper all agree on when things happened. Nanoseconds on the monotonic clock.
+NS_PER_SECOND: Final[int] = 1_000_000_000
+SERIES_CAPACITY: Final[int] = 8192
+
+
+def now() -> int:
+    return time.monotonic_ns()
+
+
+def to_seconds(ns) -> float:
+    return ns / NS_PER_SECOND
+
+
+class TimeSeries:
+    # Preallocated ring of timestamped values, written by one thread and read by any number of
+    # others without locking. Timestamps must not decrease.
+    #
+    # The writer announces the slots it's about to overwrite in _reserved, fills them, then
+    # publishes them in _count. Readers take _count before reading and check _reserved after:
+    # if their oldest slot was reserved meanwhile, what they read may be torn and they retry.
+    capacity: int
+
+    def __init__(self, capacity: int = SERIES_CAPACITY, width: int = 1) -> None:
+        if capacity < 2:
+            raise ValueError("Capacity cannot be less than 2.")
+        self.capacity = capacity
+        self._t = np.zeros(capacity, dtype=np.int64)
+        self._values = np.zeros((capacity, width), dtype=np.float64)
+        self._count = 0
+        self._reserved = 0
+
+    def __len__(self) -> int:
+        return min(self._count, self.capacity)
+
+    def append(self, t: int, value) -> None:
+        self.extend(np.array([t]), np.array([value]))
+
+    def extend(self, ts: np.ndarray, values: np.ndarray) -> None:
+        ts = np.asarray(ts, dtype=np.int64)
+        if len(ts) == 0:
+            return
+        # Only the newest `capacity` entries fit.
+        values = np.asarray(values, dtype=np.float64).reshape(len(ts), -1)[-self.capacity :]
+        ts = ts[-self.capacity :]
+        start = self._count
+        self._reserved = start + len(ts)
+        slots = np.arange(start, start + len(ts)) % self.capacity
+        self._t[slots] = ts
+        self._values[slots] = values
+        self._count = start + len(ts)
+
+    def latest(self):
+        # (t, value) of the newest entry, or None while empty.
+        while True:
+            count = self._count
+            if count == 0:
+                return None
+            slot = (count - 1) % self.capacity
+            t, value = int(self._t[slot]), self._values[slot].copy()
+            if self._reserved - self.capacity < count:
+                return t, value
+
+    def interpolate(self, ts) -> np.ndarray:
+        # Values linearly interpolated at every time of `ts`, one row per time. Times outside
+        # the buffered span get the oldest or newest value. Binary search over the two sorted
+        # halves of the ring, nothing is copied but the rows used.
+        ts = np.atleast_1d(np.asarray(ts, dtype=np.int64))
+        while True:
+            count = self._count
+            if count == 0:
+                raise LookupError("Nothing was recorded yet.")
+            size = min(count, self.capacity)
+            oldest = count - size
+            start = oldest % self.capacity
+
+            # Logically, the buffer is _t[start:] (if full), then _t[:start].
+            head = self._t[start : start + size] if start + size <= self.capacity else self._t[start:]
+            tail = self._t[: size - len(head)]
+            if len(tail) > 0:
+                positions = np.where(
+                    ts >= tail[0],
+                    len(head) + np.searchsorted(tail, ts, side="right"),
+                    np.searchsorted(head, ts, side="right"),
+                )
+            else:
+                positions = np.searchsorted(head, ts, side="right")
+
+            if size == 1:
+                after = before = np.zeros_like(positions)
+            else:
+                after = np.clip(positions, 1, size - 1)
+                before = after - 1
+            t0 = self._t[(before + start) % self.capacity]
+            t1 = self._t[(after + start) % self.capacity]
+            v0 = self._values[(before + start) % self.capacity]
+            v1 = self._values[(after + start) % self.capacity]
+
+            if self._reserved - self.capacity <= oldest:
+                break
+
+        span = (t1 - t0).astype(np.float64)
+        weight = np.divide(ts - t0, span, out=np.zeros(len(ts)), where=span > 0)
+        weight = np.clip(weight, 0.0, 1.0)[:, None]
+        return v0 + (v1 - v0) * weight
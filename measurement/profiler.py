@@ -0,0 +1,180 @@
+from typing import Dict, Final, List, Optional
+
+import functools
+import json
+import threading
+import time
+
+# Histogram bucket constants.
+# Every octave [2^k, 2^(k + 1)) ns is split into BUCKETS_PER_OCTAVE equal parts, so bucket
+# k * 4 + j holds durations in [2^k * (4 + j) / 4, 2^k * (5 + j) / 4) ns. That makes buckets
+# 25%, 20%, 17% then 14% as wide as their lower bound, and 160 of them cover up to ~18 minutes.
+BUCKETS_PER_OCTAVE: Final[int] = 4
+BUCKET_COUNT: Final[int] = 40 * BUCKETS_PER_OCTAVE
+
+
+def _bucket_of(ns: int) -> int:
+    if ns < 1:
+        return 0
+    # bit_length() finds the octave, the leading bits below it pick the bucket within.
+    octave = ns.bit_length() - 1
+    fraction = ((ns << 2) >> octave) & 0b11
+    return min(octave * BUCKETS_PER_OCTAVE + fraction, BUCKET_COUNT - 1)
+
+
+def _bucket_upper_bound(bucket: int) -> int:
+    octave, fraction = divmod(bucket + 1, BUCKETS_PER_OCTAVE)
+    return ((BUCKETS_PER_OCTAVE + fraction) << octave) // BUCKETS_PER_OCTAVE
+
+
+class SpanStats:
+    # Aggregated durations of one named span, in a fixed number of buckets, 4 per octave.
+    name: str
+    count: int
+    total_ns: int
+    min_ns: int
+    max_ns: int
+    buckets: List[int]
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * BUCKET_COUNT
+
+    def record(self, ns: int) -> None:
+        if self.count == 0 or ns < self.min_ns:
+            self.min_ns = ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.count += 1
+        self.total_ns += ns
+        self.buckets[_bucket_of(ns)] += 1
+
+    def percentile(self, p: float) -> int:
+        # Upper bound of the bucket holding the p-th percentile, clamped to what was observed.
+        if self.count == 0:
+            return 0
+        rank = max(int(self.count * p / 100 + 0.5), 1)
+        seen = 0
+        for bucket, hits in enumerate(self.buckets):
+            seen += hits
+            if seen >= rank:
+                return min(max(_bucket_upper_bound(bucket), self.min_ns), self.max_ns)
+        return self.max_ns
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns / self.count if self.count else 0,
+            "min_ns": self.min_ns,
+            "p50_ns": self.percentile(50),
+            "p90_ns": self.percentile(90),
+            "p99_ns": self.percentile(99),
+            "max_ns": self.max_ns,
+        }
+
+
+class Profiler:
+    # Registry of named spans. While disabled, profiled calls cost one attribute check.
+    enabled: bool
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._spans: Dict[str, SpanStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, ns: int) -> None:
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = SpanStats(name)
+            stats.record(ns)
+
+    def span(self, name: str) -> "_Span":
+        # with profiler.span("name"): ...
+        return _Span(self, name)
+
+    def profile(self, name: Optional[str] = None):
+        # Decorator recording every call of the target under `name`, its qualified name by default.
+        def decorator(target):
+            span_name = name or target.__qualname__
+
+            @functools.wraps(target)
+            def wrapper_func(*args, **kwargs):
+                if not self.enabled:
+                    return target(*args, **kwargs)
+                start_time = time.perf_counter_ns()
+                try:
+                    return target(*args, **kwargs)
+                finally:
+                    self.record(span_name, time.perf_counter_ns() - start_time)
+
+            return wrapper_func
+
+        return decorator
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+    def stats(self) -> Dict[str, SpanStats]:
+        with self._lock:
+            return dict(self._spans)
+
+    def to_json(self) -> str:
+        return json.dumps({name: s.summary() for name, s in self.stats().items()}, indent=2)
+
+    def to_table(self) -> str:
+        header = f"{'span':<40} {'count':>8} {'mean':>10} {'min':>10} {'p50':>10} {'p90':>10} {'p99':>10} {'max':>10}"
+        lines = [header, "-" * len(header)]
+        for name, s in sorted(self.stats().items()):
+            summary = s.summary()
+            durations = [
+                _format_ns(summary[key])
+                for key in ("mean_ns", "min_ns", "p50_ns", "p90_ns", "p99_ns", "max_ns")
+            ]
+            lines.append(f"{name:<40} {s.count:>8} " + " ".join(f"{d:>10}" for d in durations))
+        return "\n".join(lines)
+
+
+class _Span:
+    def __init__(self, profiler: Profiler, name: str) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._start = 0
+
+    def __enter__(self) -> "_Span":
+        if self._profiler.enabled:
+            self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._profiler.enabled and self._start:
+            self._profiler.record(self._name, time.perf_counter_ns() - self._start)
+
+
+def _format_ns(ns: float) -> str:
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= scale:
+            return f"{ns / scale:.2f} {unit}"
+    return f"{ns:.0f} ns"
+
+
+# Process-wide registry, and shortcuts to it.
+default_profiler = Profiler()
+profile = default_profiler.profile
+span = default_profiler.span
+to_table = default_profiler.to_table
+to_json = default_profiler.to_json
+
+
+def enable() -> None:
+    default_profiler.enabled = True
+
+
+def disable() -> None:
+    default_profiler.enabled = False
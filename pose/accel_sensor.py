@@ -1,5 +1,12 @@
-import math
+from measurement import clock
+from measurement import profiler
+from pose import orientation
+from typing import Callable, Final, Optional
+
+import numpy as np
 import smbus
+import struct
+import threading
 import time
 
 MPU9250_WHO_AM_I = 0x75
@@ -16,6 +23,9 @@ MPU9250_GYRO_XOUT_H = 0x43
 MPU9250_GYRO_YOUT_H = 0x45
 MPU9250_GYRO_ZOUT_H = 0x47
 
+# Burst of ACCEL_XOUT_H .. GYRO_ZOUT_L: accelerometer, temperature and gyroscope words, big endian.
+MPU9250_MOTION_BLOCK: Final[struct.Struct] = struct.Struct(">7h")
+
 # Magnetometer.
 MPU9250_RA_XOUT_L = 0x03
 MPU9250_RA_XOUT_H = 0x04
@@ -24,6 +34,12 @@ MPU9250_RA_YOUT_H = 0x06
 MPU9250_RA_ZOUT_L = 0x07
 MPU9250_RA_ZOUT_H = 0x08
 
+# Burst of HXL .. HZH and ST2: magnetometer words, little endian, then the status.
+# Reading ST2 ends the measurement, so it has to be part of every read.
+AK8963_COMPASS_BLOCK: Final[struct.Struct] = struct.Struct("<3hB")
+# ST2 bit set when the measurement overflowed and must be discarded.
+AK8963_HOFL = 0x08
+
 # Configuration.
 MPU9250_CONFIG = 0x1A
 MPU9250_ACC_DLPF = 0x1D
@@ -33,33 +49,79 @@ MPU9250_ACC_CONFIG_2 = 0x1D
 MPU9250_POWER_MGNT = 0x6B
 MPU9250_USER_CTRL = 0x6A
 MPU9250_PIN = 0x37
+MPU9250_SMPLRT_DIV = 0x19
+MPU9250_FIFO_EN = 0x23
+MPU9250_INT_ENABLE = 0x38
+MPU9250_INT_STATUS = 0x3A
+MPU9250_FIFO_COUNTH = 0x72
+MPU9250_FIFO_R_W = 0x74
 AK8963_CTRL_1 = 0x0A
 AK8963_ST2 = 0x09
 AK8963_ASA_X = 0x10
 AK8963_ASA_Y = 0x11
 AK8963_ASA_Z = 0x12
 
+# FIFO.
+# Queue accelerometer, temperature and gyroscope. Frames then look like the motion block.
+FIFO_EN_MOTION = 0xF8
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RST = 0x04
+INT_FIFO_OVERFLOW = 0x10
+# CONFIG: stop queueing when the FIFO is full rather than overwriting frames, and have the
+# gyroscope DLPF at 184Hz so that SMPLRT_DIV divides a 1kHz internal rate.
+CONFIG_FIFO_MODE = 0x40
+CONFIG_DLPF_184HZ = 0x01
+FIFO_FRAME_SIZE = MPU9250_MOTION_BLOCK.size
+FIFO_COUNT_MASK = 0x1FFF
+# SMBus block reads top out at 32 bytes, read whole frames at a time.
+FIFO_READ_SIZE = 32 // FIFO_FRAME_SIZE * FIFO_FRAME_SIZE
+
 # Scale factors.
 # https://github.com/bolderflight/invensense-imu/blob/main/src/mpu9250.cpp#L165
 ACCEL_SCALE_FACTOR = 8.0 / 32768.0  # Accelerator range +- 8g
-GYRO_SCALE_FACTOR = 25.0 / 32768.0  # Gyro degree per second +- 250
+GYRO_SCALE_FACTOR = 250.0 / 32768.0  # Gyro degree per second +- 250
 MAGNETIC_SCALE = 4912.0 / 32768.0  # Assuming 16-bit output. unit is uT.
-MAGNETIC_DECLINATION = 0.1418953 # 2023-12-02, Mokpo, in radian.
+MAGNETIC_DECLINATION = orientation.MAGNETIC_DECLINATION
+# Degrees Celsius = raw / sensitivity + 21, see the MPU9250 register map.
+TEMPERATURE_SENSITIVITY = 333.87
+TEMPERATURE_OFFSET = 21.0
 
 SAMPLE_DIVISION = 0
 MPU9250_SAMPLING_FREQ = 1000 / (SAMPLE_DIVISION + 1) # We use sampling rate 1000Hz.
 MPU9250_SAMPLING_PERIOD = 1 / MPU9250_SAMPLING_FREQ
 
-ALPHA = 0.96
+# The 512 byte FIFO holds 36 frames, 36ms at 1kHz. Drain it well before that.
+FIFO_DRAIN_PERIOD = 0.01
+# Share of the gap between FIFO frame times and the host clock closed by every drain. Frames are
+# a steady period apart, while the host only roughly knows when it read them, so the clock is
+# followed slowly. With the MPU9250 oscillator off by its 1% tolerance, frames lag by about 1ms.
+FIFO_CLOCK_GAIN = 0.1
+
+# The AK8963 updates at 100Hz, there's no point in reading it faster.
+COMPASS_FREQ = 100
+SAMPLER_CAPACITY = 4096
+# One record per sample taken by MPU9250Sampler. t is clock.now(), gyro is in degree
+# per second, accel in g and compass in uT. The compass holds the latest valid measurement.
+SAMPLE_DTYPE = np.dtype(
+    [
+        ("t", "<i8"),
+        ("accel", "<f4", 3),
+        ("gyro", "<f4", 3),
+        ("compass", "<f4", 3),
+        ("temperature", "<f4"),
+    ]
+)
 
 class MPU9250:
     address: int
     bus: smbus.SMBus
     accel_data: list[int]
     gyro_data: list[int]
+    gyro_rate: list[int]
+    temperature: float
     compass_data: list[int]
     compass_adjustment: list[int]
-    orientation: list[int]
+    orientation: list[float]
 
     def __init__(self, address=0x68, bus_number=1):
         self.MPU9250_ADDRESS = address
@@ -67,9 +129,20 @@ class MPU9250:
 
         self.accel_data = [0, 0, 0]
         self.gyro_data = [0, 0, 0]
+        self.gyro_rate = [0, 0, 0]
+        self.temperature = 0.0
+        # Seconds between FIFO frames while the FIFO is enabled, None otherwise.
+        self.fifo_period = None
+        self.fifo_overflows = 0
+        # Time of the newest frame drained so far, and whether the next drain must be anchored to
+        # the host clock anew rather than follow on from it.
+        self._fifo_time: Optional[int] = None
+        self._fifo_anchored = False
         self.compass_data = [0, 0, 0]
         self.compass_adjustment = [0, 0, 0]
+        # Pitch, roll and yaw in radians.
         self.orientation = [0, 0, 0]
+        self._orientation_filter = orientation.OrientationFilter()
 
         # This needs some time to avoid Remote IOError.
         # https://stackoverflow.com/questions/52735862/getting-ioerror-errno-121-remote-i-o-error-with-smbus-on-python-raspberry-w
@@ -126,11 +199,15 @@ class MPU9250:
         # Wait for it again
         time.sleep(0.1)
         # Let AK8963 emit the 16-bit output and update in 100Hz frequency.
-        self.bus.write_byte_data(AK8963_ADDR, AK8963_CTRL_1, 0x16)wqX
+        self.bus.write_byte_data(AK8963_ADDR, AK8963_CTRL_1, 0x16)
 
     def read_byte(self, addr, reg):
         return self.bus.read_byte_data(addr, reg)
 
+    def read_block(self, addr, reg, length) -> bytes:
+        # Consecutive registers in a single I2C transaction.
+        return bytes(self.bus.read_i2c_block_data(addr, reg, length))
+
     def read_word(self, addr, reg, reverse=False):
         offset = -1 if reverse else 1
         high = self.bus.read_byte_data(addr, reg)
@@ -144,63 +221,158 @@ class MPU9250:
             value = -((65535 - value) + 1)
         return value
 
+    def read_motion(self):
+        # Accelerometer, temperature and gyroscope, sampled together, in one 14 byte burst.
+        ax, ay, az, temperature, gx, gy, gz = MPU9250_MOTION_BLOCK.unpack(
+            self.read_block(self.MPU9250_ADDRESS, MPU9250_ACCEL_XOUT_H, MPU9250_MOTION_BLOCK.size)
+        )
+        self.accel_data = [
+            ax * ACCEL_SCALE_FACTOR,
+            ay * ACCEL_SCALE_FACTOR,
+            az * ACCEL_SCALE_FACTOR,
+        ]
+        self.temperature = temperature / TEMPERATURE_SENSITIVITY + TEMPERATURE_OFFSET
+        self.gyro_rate = [gx * GYRO_SCALE_FACTOR, gy * GYRO_SCALE_FACTOR, gz * GYRO_SCALE_FACTOR]
+
     def read_acceleration(self):
-        x = self.read_word(self.MPU9250_ADDRESS, MPU9250_ACCEL_XOUT_H)
-        y = self.read_word(self.MPU9250_ADDRESS, MPU9250_ACCEL_YOUT_H)
-        z = self.read_word(self.MPU9250_ADDRESS, MPU9250_ACCEL_ZOUT_H)
+        x, y, z = struct.unpack(">3h", self.read_block(self.MPU9250_ADDRESS, MPU9250_ACCEL_XOUT_H, 6))
         self.accel_data = [
             x * ACCEL_SCALE_FACTOR,
             y * ACCEL_SCALE_FACTOR,
             z * ACCEL_SCALE_FACTOR,
         ]
 
-    def read_gyroscope(self):
-        x = self.read_word(self.MPU9250_ADDRESS, MPU9250_GYRO_XOUT_H)
-        y = self.read_word(self.MPU9250_ADDRESS, MPU9250_GYRO_YOUT_H)
-        z = self.read_word(self.MPU9250_ADDRESS, MPU9250_GYRO_ZOUT_H)
-        self.gyro_data[0] = self.gyro_data[0] + x * GYRO_SCALE_FACTOR * MPU9250_SAMPLING_PERIOD 
-        self.gyro_data[1] = self.gyro_data[1] + y * GYRO_SCALE_FACTOR * MPU9250_SAMPLING_PERIOD
-        self.gyro_data[2] = self.gyro_data[2] + z * GYRO_SCALE_FACTOR * MPU9250_SAMPLING_PERIOD
-
-    def read_ra(self):
-        x = self.read_word(AK8963_ADDR, MPU9250_RA_XOUT_H, True) * self.compass_adjustment[0]
-        y = self.read_word(AK8963_ADDR, MPU9250_RA_YOUT_H, True) * self.compass_adjustment[1]
-        z = self.read_word(AK8963_ADDR, MPU9250_RA_ZOUT_H, True) * self.compass_adjustment[2]
-        self.compass_data = [x * MAGNETIC_SCALE, y * MAGNETIC_SCALE, z * MAGNETIC_SCALE]
-
-        # We must read ST2 register in order to update the magnetic measurement
+    def read_gyroscope(self, dt=MPU9250_SAMPLING_PERIOD):
+        x, y, z = struct.unpack(">3h", self.read_block(self.MPU9250_ADDRESS, MPU9250_GYRO_XOUT_H, 6))
+        self.gyro_rate = [x * GYRO_SCALE_FACTOR, y * GYRO_SCALE_FACTOR, z * GYRO_SCALE_FACTOR]
+        self._integrate_gyroscope(dt)
+
+    def read_ra(self) -> bool:
+        # Returns False when the measurement overflowed, compass_data is left as it was then.
+        # We must read ST2 register in order to update the magnetic measurement, it's the last
+        # byte of the burst.
         # https://download.mikroe.com/documents/datasheets/ak8963c-datasheet.pdf
-        record2 = self.bus.read_byte_data(AK8963_ADDR, 0x0A)
-        print(record2)
-        record = self.bus.read_byte_data(AK8963_ADDR, AK8963_ST2)
-        print(record)
-
-    def update_data(self):
-        self.read_acceleration()
-        self.read_gyroscope()
+        x, y, z, st2 = AK8963_COMPASS_BLOCK.unpack(
+            self.read_block(AK8963_ADDR, MPU9250_RA_XOUT_L, AK8963_COMPASS_BLOCK.size)
+        )
+        if st2 & AK8963_HOFL:
+            return False
+        self.compass_data = [
+            x * self.compass_adjustment[0] * MAGNETIC_SCALE,
+            y * self.compass_adjustment[1] * MAGNETIC_SCALE,
+            z * self.compass_adjustment[2] * MAGNETIC_SCALE,
+        ]
+        return True
+
+    def update_data(self, dt=MPU9250_SAMPLING_PERIOD):
+        # dt is the time since the previous update, in seconds.
+        self.read_motion()
+        self._integrate_gyroscope(dt)
         self.read_ra()
         self.update_orientation()
 
+    def _integrate_gyroscope(self, dt):
+        self.gyro_data[0] = self.gyro_data[0] + self.gyro_rate[0] * dt
+        self.gyro_data[1] = self.gyro_data[1] + self.gyro_rate[1] * dt
+        self.gyro_data[2] = self.gyro_data[2] + self.gyro_rate[2] * dt
+
+    def enable_fifo(self, sample_division=SAMPLE_DIVISION):
+        # Has the MPU9250 queue a frame on chip every 1 / (1kHz / (1 + sample_division)) seconds,
+        # to be collected with drain_fifo(). The AK8963 isn't routed through the FIFO in
+        # bypass mode, so the compass is still read with read_ra().
+        self.bus.write_byte_data(
+            self.MPU9250_ADDRESS, MPU9250_CONFIG, CONFIG_FIFO_MODE | CONFIG_DLPF_184HZ
+        )
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_SMPLRT_DIV, sample_division)
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_INT_ENABLE, INT_FIFO_OVERFLOW)
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_FIFO_EN, FIFO_EN_MOTION)
+        self.fifo_period = (sample_division + 1) / 1000
+        self.reset_fifo()
+
+    def disable_fifo(self):
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_FIFO_EN, 0x00)
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_USER_CTRL, 0x00)
+        self.fifo_period = None
+
+    def reset_fifo(self):
+        # Empties the FIFO, so that it starts over on a frame boundary.
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_USER_CTRL, USER_CTRL_FIFO_RST)
+        self.bus.write_byte_data(self.MPU9250_ADDRESS, MPU9250_USER_CTRL, USER_CTRL_FIFO_EN)
+        # Reading INT_STATUS clears the overflow flag of the previous run.
+        self.read_byte(self.MPU9250_ADDRESS, MPU9250_INT_STATUS)
+        # Frames may have been lost, the next ones are anchored to the host clock anew.
+        self._fifo_anchored = False
+
+    def fifo_count(self):
+        high, low = self.read_block(self.MPU9250_ADDRESS, MPU9250_FIFO_COUNTH, 2)
+        return ((high << 8) | low) & FIFO_COUNT_MASK
+
+    def drain_fifo(self) -> np.ndarray:
+        # Every complete frame in the FIFO, oldest first, as SAMPLE_DTYPE records.
+        # Frames carry no time, but they're a period apart. They're stamped from the newest frame
+        # of the previous drain on, with that time base pulled towards the host clock by
+        # FIFO_CLOCK_GAIN, as of when the FIFO was counted. Times never go backwards, so every
+        # drain can go straight into a clock.TimeSeries.
+        # If the FIFO overflowed, frames were lost and the rest may be misaligned, so it's
+        # emptied instead, counted in fifo_overflows, and nothing is returned.
+        if self.fifo_period is None:
+            raise RuntimeError("The FIFO isn't enabled.")
+        status = self.read_byte(self.MPU9250_ADDRESS, MPU9250_INT_STATUS)
+        if status & INT_FIFO_OVERFLOW:
+            self.fifo_overflows += 1
+            self.reset_fifo()
+            return np.zeros(0, dtype=SAMPLE_DTYPE)
+
+        size = self.fifo_count() // FIFO_FRAME_SIZE * FIFO_FRAME_SIZE
+        # The newest counted frame was taken right before this, reading it out takes a while.
+        now = clock.now()
+        data = b"".join(
+            self.read_block(
+                self.MPU9250_ADDRESS, MPU9250_FIFO_R_W, min(FIFO_READ_SIZE, size - offset)
+            )
+            for offset in range(0, size, FIFO_READ_SIZE)
+        )
+        frames = np.frombuffer(data, dtype=">i2").reshape(-1, 7)
+        if len(frames) == 0:
+            return np.zeros(0, dtype=SAMPLE_DTYPE)
+
+        period = int(self.fifo_period * 1e9)
+        if self._fifo_time is None:
+            self._fifo_time = now
+        else:
+            expected = self._fifo_time + len(frames) * period
+            gain = FIFO_CLOCK_GAIN if self._fifo_anchored else 1.0
+            newest = expected + int((now - expected) * gain)
+            # The oldest frame can't come before the newest one of the previous drain.
+            self._fifo_time = max(newest, self._fifo_time + (len(frames) - 1) * period)
+        self._fifo_anchored = True
+
+        records = np.zeros(len(frames), dtype=SAMPLE_DTYPE)
+        age = np.arange(len(frames) - 1, -1, -1, dtype=np.int64)
+        records["t"] = self._fifo_time - age * period
+        records["accel"] = frames[:, 0:3] * ACCEL_SCALE_FACTOR
+        records["temperature"] = frames[:, 3] / TEMPERATURE_SENSITIVITY + TEMPERATURE_OFFSET
+        records["gyro"] = frames[:, 4:7] * GYRO_SCALE_FACTOR
+        records["compass"] = self.compass_data
+
+        if len(records) > 0:
+            last = records[-1]
+            self.accel_data = last["accel"].tolist()
+            self.gyro_rate = last["gyro"].tolist()
+            self.temperature = float(last["temperature"])
+        return records
+
     def update_orientation(self):
-        ax, ay, az = self.accel_data[0], self.accel_data[1], self.accel_data[2]
-        pitch_accel = math.atan2(ay, math.sqrt(ax*ax + az*az)) * 180 / math.pi
-        roll_accel = math.atan2(-ax, math.sqrt(ay*ay + az*az)) * 180 / math.pi
-
-        pitch_angle, roll_angle = self.orientation[0], self.orientation[1]
-        # https://gist.github.com/shoebahmedadeel/0d8ca4eaa65664492cf1db2ab3a9e572
-        yh = self.compass_data[1] * math.cos(roll_accel) - self.compass_data[2] * math.sin(roll_accel)
-        xh = self.compass_data[0] * math.cos(pitch_accel) + self.compass_data[1] * math.sin(roll_accel) * math.cos(pitch_accel) \
-            + self.compass_data[2] * math.cos(roll_accel) * math.sin(pitch_accel)
-        gx, gy = self.gyro_data[0] , self.gyro_data[1]
-
-        # Complementary filter.
-        pitch_angle = ALPHA * (gx + pitch_angle) + (1 - ALPHA) * pitch_accel
-        roll_angle = ALPHA * (gy + roll_angle) + (1 - ALPHA) * roll_accel
-        yaw_angle = math.atan2(yh, xh) * 180 / math.pi + MAGNETIC_DECLINATION
-
-        self.orientation[0] = pitch_angle
-        self.orientation[1] = roll_angle
-        self.orientation[2] = yaw_angle
+        # One sample at a time. Whole batches, as given by drain_fifo() or
+        # MPU9250Sampler.snapshot(), are much cheaper to hand to an OrientationFilter directly.
+        sample = np.zeros(1, dtype=SAMPLE_DTYPE)
+        sample["t"] = clock.now()
+        sample["accel"] = self.accel_data
+        sample["gyro"] = self.gyro_rate
+        sample["compass"] = self.compass_data
+        self._orientation_filter.update(sample)
+        _, pitch, roll, yaw = self._orientation_filter.latest()
+        self.orientation = [pitch, roll, yaw]
 
     def get_raw_acceleration(self):
         return self.accel_data
@@ -213,3 +385,179 @@ class MPU9250:
 
     def get_ra(self):
         return self.compass_data
+
+
+class MPU9250Sampler:
+    # Samples an MPU9250 at a fixed rate on a background thread, into a preallocated ring of
+    # SAMPLE_DTYPE records. Deadlines are absolute, so the rate doesn't drift with how long the
+    # reads take. Waking up a period or more late is an overrun: the missed periods are
+    # skipped rather than made up for in a burst.
+    #
+    # With fifo=True the MPU9250 keeps time instead: frames queue up in its FIFO at `rate`
+    # (rounded to 1kHz / n) and the thread only drains it every FIFO_DRAIN_PERIOD, so stalls of
+    # the host up to the FIFO's depth lose nothing. Overflows are counted as overruns.
+    #
+    # A consumer, e.g. HeadingTracker.add_samples, gets every new sample, in batches handed
+    # over every FIFO_DRAIN_PERIOD on the sampling thread.
+    sensor: MPU9250
+    rate: float
+    capacity: int
+    samples: int
+    overruns: int
+    errors: int
+    jitter: profiler.SpanStats
+
+    def __init__(
+        self,
+        sensor: MPU9250,
+        rate: float = MPU9250_SAMPLING_FREQ,
+        capacity: int = SAMPLER_CAPACITY,
+        fifo: bool = False,
+        consumer: Optional[Callable[[np.ndarray], None]] = None,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError("Rate must be positive.")
+        if capacity < 1:
+            raise ValueError("Capacity cannot be less than 1.")
+        self.sensor = sensor
+        self.rate = rate
+        self.capacity = capacity
+        self.fifo = fifo
+        self.consumer = consumer
+        self.samples = 0
+        self.overruns = 0
+        self.errors = 0
+        # How late every sample was taken, against its deadline.
+        self.jitter = profiler.SpanStats("jitter")
+        self._ring = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started_ns = 0
+        self._consumed = 0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            raise RuntimeError("The sampler is running already.")
+        self._stop.clear()
+        target = self._run_fifo if self.fifo else self._run
+        self._thread = threading.Thread(target=target, name="mpu9250-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self) -> Optional[np.void]:
+        with self._lock:
+            if self.samples == 0:
+                return None
+            return self._ring[(self.samples - 1) % self.capacity].copy()
+
+    def snapshot(self, since_ns: Optional[int] = None) -> np.ndarray:
+        # Buffered samples in time order, only those taken after since_ns if given.
+        with self._lock:
+            count = min(self.samples, self.capacity)
+            oldest = self.samples - count
+            records = self._ring[(np.arange(count) + oldest) % self.capacity]
+        if since_ns is not None:
+            records = records[records["t"] > since_ns]
+        return records
+
+    def stats(self) -> dict:
+        elapsed = (clock.now() - self._started_ns) / 1e9 if self._started_ns else 0
+        return {
+            "samples": self.samples,
+            "rate": self.samples / elapsed if elapsed > 0 else 0.0,
+            "overruns": self.overruns,
+            "errors": self.errors,
+            "jitter": self.jitter.summary(),
+        }
+
+    def _run(self) -> None:
+        period_ns = int(1e9 / self.rate)
+        compass_every = max(int(self.rate // COMPASS_FREQ), 1)
+        consume_every = max(int(self.rate * FIFO_DRAIN_PERIOD), 1)
+        ticks = 0
+        self._started_ns = deadline = clock.now()
+        while not self._stop.is_set():
+            now = clock.now()
+            if deadline > now:
+                time.sleep((deadline - now) / 1e9)
+
+            before = clock.now()
+            try:
+                self.sensor.read_motion()
+                if ticks % compass_every == 0:
+                    self.sensor.read_ra()
+            except OSError:
+                # Remote I/O errors happen now and then on the bus, skip the sample.
+                self.errors += 1
+            else:
+                # The sample is stamped halfway through the transactions.
+                self._append((before + clock.now()) // 2)
+                if self.consumer is not None and ticks % consume_every == 0:
+                    self._consume()
+
+            late = before - deadline
+            self.jitter.record(max(late, 0))
+            if late >= period_ns:
+                missed = late // period_ns
+                self.overruns += missed
+                deadline += missed * period_ns
+            deadline += period_ns
+            ticks += 1
+
+    def _run_fifo(self) -> None:
+        sensor = self.sensor
+        sensor.enable_fifo(max(round(1000 / self.rate) - 1, 0))
+        period_ns = int(FIFO_DRAIN_PERIOD * 1e9)
+        overflows = sensor.fifo_overflows
+        self._started_ns = deadline = clock.now()
+        try:
+            while not self._stop.wait(max(deadline - clock.now(), 0) / 1e9):
+                self.jitter.record(max(clock.now() - deadline, 0))
+                deadline += period_ns
+                try:
+                    sensor.read_ra()
+                    records = sensor.drain_fifo()
+                except OSError:
+                    self.errors += 1
+                    continue
+                self.overruns += sensor.fifo_overflows - overflows
+                overflows = sensor.fifo_overflows
+                self._extend(records)
+                if self.consumer is not None:
+                    self._consume()
+        finally:
+            sensor.disable_fifo()
+
+    def _consume(self) -> None:
+        # Hands the samples taken since the last call to the consumer, those still buffered.
+        with self._lock:
+            first = max(self._consumed, self.samples - self.capacity)
+            records = self._ring[np.arange(first, self.samples) % self.capacity]
+            self._consumed = self.samples
+        if len(records) > 0:
+            self.consumer(records)
+
+    def _extend(self, records: np.ndarray) -> None:
+        with self._lock:
+            # Only the newest `capacity` records fit.
+            records = records[-self.capacity :]
+            indices = (np.arange(len(records)) + self.samples) % self.capacity
+            self._ring[indices] = records
+            self.samples += len(records)
+
+    def _append(self, t: int) -> None:
+        sensor = self.sensor
+        with self._lock:
+            record = self._ring[self.samples % self.capacity]
+            record["t"] = t
+            record["accel"] = sensor.accel_data
+            record["gyro"] = sensor.gyro_rate
+            record["compass"] = sensor.compass_data
+            record["temperature"] = sensor.temperature
+            self.samples += 1
@@ -0,0 +1,74 @@
+from dataclasses import replace
+from lidar import g2
+from measurement import clock
+from pose import orientation
+from typing import Final, Optional
+
+import math
+import numpy as np
+
+# 16 seconds of yaw at 1kHz.
+HEADING_HISTORY: Final[int] = 16384
+
+
+class HeadingTracker:
+    # Yaw of the IMU over time, to pair LiDAR revolutions with the heading they were taken at.
+    # IMU batches go through an OrientationFilter into a TimeSeries, which scans then look up
+    # by their timestamp. Feed it from one thread, e.g. as the consumer of an MPU9250Sampler;
+    # lookups may come from any other.
+    orientation_filter: orientation.OrientationFilter
+    yaw: clock.TimeSeries
+
+    def __init__(
+        self,
+        capacity: int = HEADING_HISTORY,
+        orientation_filter: Optional[orientation.OrientationFilter] = None,
+    ) -> None:
+        self.orientation_filter = orientation_filter or orientation.OrientationFilter()
+        self.yaw = clock.TimeSeries(capacity)
+
+    def add_samples(self, samples: np.ndarray) -> None:
+        # IMU samples as accel_sensor.SAMPLE_DTYPE records, in time order.
+        filtered = self.orientation_filter.update(samples)
+        self.yaw.extend(filtered.t, filtered.yaw)
+
+    def heading_at(self, ts) -> np.ndarray:
+        # Yaw in radians, unwrapped, interpolated at every clock.now() time of `ts`.
+        return self.yaw.interpolate(ts)[:, 0]
+
+    def attach(self, scan: g2.LaserScan) -> g2.LaserScan:
+        # The scan, with the heading at its timestamp. Left as is until the IMU has reported.
+        if len(self.yaw) == 0:
+            return scan
+        return replace(scan, heading=float(self.heading_at(scan.timestamp)[0]))
+
+    def deskew(
+        self, scan: g2.LaserScan, velocity: Optional[tuple[float, float]] = None
+    ) -> g2.LaserScan:
+        # The scan as if it was taken all at once at scan.timestamp, with the heading at that
+        # time. Every sample is rotated by how much the observer turned between when it was
+        # taken and the end of the revolution. With a velocity, (x, y) in mm/s in the observer
+        # frame at the end of the revolution, the distance travelled is undone as well.
+        # Scans without sample times are only given their heading.
+        if len(self.yaw) == 0 or scan.sample_times is None or len(scan) == 0:
+            return self.attach(scan)
+
+        yaws = self.heading_at(np.append(scan.sample_times, scan.timestamp))
+        reference = yaws[-1]
+        radians = scan.radians + (yaws[:-1] - reference)
+        distances = scan.distances
+        if velocity is not None:
+            # Where the observer was when each sample was taken, relative to the end.
+            elapsed = (scan.sample_times - scan.timestamp) / clock.NS_PER_SECOND
+            xs = distances * np.cos(radians) + velocity[0] * elapsed
+            ys = distances * np.sin(radians) + velocity[1] * elapsed
+            radians = np.arctan2(ys, xs)
+            # Missed returns stay missed, whatever the observer did.
+            distances = np.where(distances > 0, np.rint(np.hypot(xs, ys)), 0).astype(np.int64)
+
+        return replace(
+            scan,
+            radians=np.mod(radians, 2 * math.pi),
+            distances=distances,
+            heading=float(reference),
+        )
@@ -0,0 +1,140 @@
+from dataclasses import dataclass
+from typing import Final, Optional
+
+import math
+import numpy as np
+
+MAGNETIC_DECLINATION: Final[float] = 0.1418953  # 2023-12-02, Mokpo, in radian.
+
+# Time constants of the complementary filter, in seconds. Below them the gyroscope is trusted,
+# above them the accelerometer (pitch, roll) and the compass (yaw) take over.
+# 0.024s matches the former per-sample ALPHA = 0.96 at 1kHz.
+TILT_TIME_CONSTANT: Final[float] = 0.024
+YAW_TIME_CONSTANT: Final[float] = 1.0
+# The recursion is solved in closed form this many samples at a time. Gains are clamped
+# so that their product over a block stays far from float64 underflow.
+BLOCK_SIZE: Final[int] = 64
+MIN_GAIN: Final[float] = 1e-4
+
+
+@dataclass
+class Orientation:
+    # One entry per sample. t is in ns, angles in radians. Yaw is unwrapped, so it's
+    # continuous across +-pi and can be interpolated directly.
+    t: np.ndarray
+    pitch: np.ndarray
+    roll: np.ndarray
+    yaw: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+
+class OrientationFilter:
+    # Complementary filter over batches of IMU samples, structured arrays with the fields of
+    # accel_sensor.SAMPLE_DTYPE: t (monotonic ns), accel (g), gyro (degree per second) and
+    # compass (uT). The time between samples is taken from t, so batches from the FIFO, the
+    # polling sampler or a log all work, gaps included.
+    #
+    # Per axis, angle[k] = a[k] * (angle[k - 1] + rate[k] * dt[k]) + (1 - a[k]) * measured[k]
+    # with a[k] = tau / (tau + dt[k]). That's a first order linear recursion, which is
+    # evaluated with cumulative products and sums rather than one Python step per sample.
+    tilt_time_constant: float
+    yaw_time_constant: Optional[float]
+    declination: float
+
+    def __init__(
+        self,
+        tilt_time_constant: float = TILT_TIME_CONSTANT,
+        yaw_time_constant: Optional[float] = YAW_TIME_CONSTANT,
+        declination: float = MAGNETIC_DECLINATION,
+    ) -> None:
+        # Without a yaw time constant the compass is ignored and yaw is the integrated gyroscope.
+        self.tilt_time_constant = tilt_time_constant
+        self.yaw_time_constant = yaw_time_constant
+        self.declination = declination
+        self._latest: Optional[tuple[int, float, float, float]] = None
+
+    def update(self, samples: np.ndarray) -> Orientation:
+        # Filters `samples`, in time order, on from where the previous batch left off.
+        if len(samples) == 0:
+            empty = np.zeros(0)
+            return Orientation(np.zeros(0, dtype=np.int64), empty, empty, empty)
+
+        t = samples["t"].astype(np.int64)
+        accel = samples["accel"].astype(np.float64)
+        gyro = np.radians(samples["gyro"].astype(np.float64))
+        ax, ay, az = accel[:, 0], accel[:, 1], accel[:, 2]
+        pitch_accel = np.arctan2(ay, np.sqrt(ax * ax + az * az))
+        roll_accel = np.arctan2(-ax, np.sqrt(ay * ay + az * az))
+
+        if self._latest is None:
+            # Nothing to integrate from, start at what the first sample measured.
+            dt = np.diff(t, prepend=t[0]) / 1e9
+            previous = (pitch_accel[0], roll_accel[0], None)
+        else:
+            last_t, last_pitch, last_roll, last_yaw = self._latest
+            dt = np.diff(t, prepend=last_t) / 1e9
+            previous = (last_pitch, last_roll, last_yaw)
+        dt = np.maximum(dt, 0)
+
+        gain = self._gains(dt, self.tilt_time_constant)
+        pitch = _recurse(gain, gain * gyro[:, 0] * dt + (1 - gain) * pitch_accel, previous[0])
+        roll = _recurse(gain, gain * gyro[:, 1] * dt + (1 - gain) * roll_accel, previous[1])
+        yaw = self._yaw(samples, pitch, roll, gyro[:, 2], dt, previous[2])
+
+        self._latest = (int(t[-1]), float(pitch[-1]), float(roll[-1]), float(yaw[-1]))
+        return Orientation(t, pitch, roll, yaw)
+
+    def latest(self) -> Optional[tuple[int, float, float, float]]:
+        # (t, pitch, roll, yaw) after the last sample filtered so far.
+        return self._latest
+
+    def reset(self) -> None:
+        self._latest = None
+
+    def _yaw(
+        self,
+        samples: np.ndarray,
+        pitch: np.ndarray,
+        roll: np.ndarray,
+        rate: np.ndarray,
+        dt: np.ndarray,
+        previous: Optional[float],
+    ) -> np.ndarray:
+        if self.yaw_time_constant is None:
+            start = 0.0 if previous is None else previous
+            return start + np.cumsum(rate * dt)
+
+        # Tilt compensated compass heading.
+        # https://gist.github.com/shoebahmedadeel/0d8ca4eaa65664492cf1db2ab3a9e572
+        compass = samples["compass"].astype(np.float64)
+        mx, my, mz = compass[:, 0], compass[:, 1], compass[:, 2]
+        cos_pitch, sin_pitch = np.cos(pitch), np.sin(pitch)
+        cos_roll, sin_roll = np.cos(roll), np.sin(roll)
+        yh = my * cos_roll - mz * sin_roll
+        xh = mx * cos_pitch + my * sin_roll * sin_pitch + mz * cos_roll * sin_pitch
+        heading = np.unwrap(np.arctan2(yh, xh) + self.declination)
+
+        if previous is None:
+            previous = heading[0]
+        else:
+            # Same turn as the running yaw, which may have wound around several times.
+            heading += 2 * math.pi * round((previous - heading[0]) / (2 * math.pi))
+        gain = self._gains(dt, self.yaw_time_constant)
+        return _recurse(gain, gain * rate * dt + (1 - gain) * heading, previous)
+
+    def _gains(self, dt: np.ndarray, time_constant: float) -> np.ndarray:
+        return np.maximum(time_constant / (time_constant + dt), MIN_GAIN)
+
+
+def _recurse(a: np.ndarray, b: np.ndarray, x0: float) -> np.ndarray:
+    # x[k] = a[k] * x[k - 1] + b[k], starting from x[-1] = x0. Within a block,
+    # x[k] = P[k] * (x0 + sum(b[j] / P[j] for j <= k)) where P is the cumulative product of a.
+    x = np.empty_like(b)
+    for start in range(0, len(b), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        products = np.cumprod(a[block])
+        x[block] = products * (x0 + np.cumsum(b[block] / products))
+        x0 = x[block][-1]
+    return x